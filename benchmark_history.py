@@ -0,0 +1,423 @@
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+from benchmark_stats import EndpointStats, find_knee
+
+RUNS_DIRECTORY = "benchmark_runs"
+BASELINE_FILE = "baseline.txt"
+
+# Two-sided 95% confidence
+Z_95 = 1.959964
+
+# Differences with a p-value below this are reported as significant
+SIGNIFICANCE_LEVEL = 0.05
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+def get_server_commit():
+    """
+    Get the commit of this checkout, which is what start.py deploys to the instances
+    Returns:
+        Commit hash with a "-dirty" suffix when there are local changes, None outside of git
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=REPOSITORY_DIRECTORY, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=REPOSITORY_DIRECTORY, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if status else "")
+
+def save_run(directory, metadata, endpoints, connections, steps=None):
+    """
+    Save the result of a benchmark run
+    Args:
+        directory: directory of the run history
+        metadata: dictionary describing the run (settings, target, clusters...)
+        endpoints: list of EndpointStats of a fixed profile run
+        connections: list of (paths, ConnectionStats) of the client sessions of a fixed profile run
+        steps: dictionary path -> list of (target rps, EndpointStats) of a step profile run
+    Returns:
+        Path of the saved run
+    """
+    os.makedirs(directory, exist_ok=True)
+    started = datetime.datetime.now(datetime.timezone.utc)
+    run_id = started.strftime("%Y%m%d-%H%M%S")
+    if metadata.get("label"):
+        run_id += f"-{metadata['label']}"
+
+    run = {
+        "id": run_id,
+        "saved_at": started.isoformat(),
+        "metadata": dict(metadata, server_commit=metadata.get("server_commit") or get_server_commit(),
+                         client_host=platform.node(), python=platform.python_version()),
+        "endpoints": [{"stats": stats.to_dict()} for stats in endpoints],
+        "connections": [
+            {"paths": paths, "stats": session_connections.to_dict()} for paths, session_connections in connections
+        ],
+        "steps": {
+            path: [{"rps": rps, "stats": stats.to_dict()} for rps, stats in path_steps]
+            for path, path_steps in (steps or {}).items()
+        },
+    }
+    path = os.path.join(directory, f"{run_id}.json")
+    with open(path, "w") as file:
+        json.dump(run, file)
+    return path
+
+def resolve_run(directory, run):
+    """
+    Find the file of a run
+    Args:
+        directory: directory of the run history
+        run: path of a run file, run id, or "baseline"
+    Returns:
+        Path of the run file
+    """
+    if run == "baseline":
+        try:
+            with open(os.path.join(directory, BASELINE_FILE)) as file:
+                run = file.read().strip()
+        except FileNotFoundError:
+            print("No baseline set, use the baseline command first.")
+            sys.exit(1)
+    if os.path.isfile(run):
+        return run
+    path = os.path.join(directory, f"{run}.json")
+    if os.path.isfile(path):
+        return path
+    print(f"Run {run} not found in {directory}.")
+    sys.exit(1)
+
+def load_run(path):
+    """
+    Load a saved run
+    Args:
+        path: path of the run file
+    Returns:
+        Run dictionary with the stats rebuilt as EndpointStats
+    """
+    with open(path) as file:
+        run = json.load(file)
+    run["endpoints"] = {
+        endpoint["stats"]["name"]: EndpointStats.from_dict(endpoint["stats"]) for endpoint in run["endpoints"]
+    }
+    run["steps"] = {
+        path: [(step["rps"], EndpointStats.from_dict(step["stats"])) for step in steps]
+        for path, steps in run["steps"].items()
+    }
+    return run
+
+def normal_two_sided_p(z):
+    """
+    Two-sided p-value of a standard normal statistic
+    """
+    return math.erfc(abs(z) / math.sqrt(2))
+
+def _betacf(a, b, x):
+    """
+    Continued fraction of the regularized incomplete beta function (Numerical Recipes)
+    """
+    tiny = 1e-300
+    qab, qap, qam = a + b, a + 1, a - 1
+    c, d = 1.0, 1 - qab * x / qap
+    d = 1 / (d if abs(d) > tiny else tiny)
+    h = d
+    for m in range(1, 300):
+        m2 = 2 * m
+        aa = m * (b - m) * x / ((qam + m2) * (a + m2))
+        d = 1 + aa * d
+        d = 1 / (d if abs(d) > tiny else tiny)
+        c = 1 + aa / c
+        c = c if abs(c) > tiny else tiny
+        h *= d * c
+        aa = -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))
+        d = 1 + aa * d
+        d = 1 / (d if abs(d) > tiny else tiny)
+        c = 1 + aa / c
+        c = c if abs(c) > tiny else tiny
+        delta = d * c
+        h *= delta
+        if abs(delta - 1) < 3e-12:
+            break
+    return h
+
+def student_t_two_sided_p(t, df):
+    """
+    Two-sided p-value of a Student t statistic
+    Args:
+        t: t statistic
+        df: degrees of freedom
+    Returns:
+        p-value
+    """
+    if t == 0:
+        return 1.0
+    x = df / (df + t * t)
+    a, b = df / 2, 0.5
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log1p(-x))
+    # Regularized incomplete beta I_x(df/2, 1/2), evaluated on the side where the fraction converges
+    if x < (a + 1) / (a + b + 2):
+        return front * _betacf(a, b, x) / a
+    return 1 - front * _betacf(b, a, 1 - x) / b
+
+def student_t_critical(df, confidence=0.95):
+    """
+    Critical value of a two-sided Student t interval, found by bisection on the p-value
+    """
+    low, high = 0.0, 100.0
+    for _ in range(100):
+        middle = (low + high) / 2
+        if student_t_two_sided_p(middle, df) > 1 - confidence:
+            low = middle
+        else:
+            high = middle
+    return high
+
+def mean_confidence_interval(samples):
+    """
+    Mean of samples with its 95% Student t confidence interval
+    Returns:
+        (mean, half width of the interval), half width is None with less than two samples
+    """
+    n = len(samples)
+    mean = sum(samples) / n
+    if n < 2:
+        return mean, None
+    variance = sum((sample - mean) ** 2 for sample in samples) / (n - 1)
+    return mean, student_t_critical(n - 1) * math.sqrt(variance / n)
+
+def welch_t_test(samples_a, samples_b):
+    """
+    Welch's t-test of the difference of two means with unequal variances
+    Returns:
+        p-value, None when either side has less than two samples
+    """
+    n_a, n_b = len(samples_a), len(samples_b)
+    if n_a < 2 or n_b < 2:
+        return None
+    mean_a, mean_b = sum(samples_a) / n_a, sum(samples_b) / n_b
+    var_a = sum((x - mean_a) ** 2 for x in samples_a) / (n_a - 1) / n_a
+    var_b = sum((x - mean_b) ** 2 for x in samples_b) / (n_b - 1) / n_b
+    if var_a + var_b == 0:
+        return 1.0 if mean_a == mean_b else 0.0
+    t = (mean_a - mean_b) / math.sqrt(var_a + var_b)
+    df = (var_a + var_b) ** 2 / (var_a ** 2 / (n_a - 1) + var_b ** 2 / (n_b - 1))
+    return student_t_two_sided_p(t, df)
+
+def mann_whitney_u(histogram_a, histogram_b):
+    """
+    Mann-Whitney U test on two latency histograms. Values sharing a bucket are treated as ties,
+    so the test runs on the bucket counts without needing the raw samples.
+    Returns:
+        (probability that a latency of A is above one of B, two-sided p-value)
+    """
+    n_a, n_b = histogram_a.total_count, histogram_b.total_count
+    if not n_a or not n_b:
+        return None, None
+
+    rank_sum_a = 0.0
+    tie_term = 0
+    seen = 0
+    for count_a, count_b in zip(histogram_a.counts, histogram_b.counts):
+        tied = count_a + count_b
+        if not tied:
+            continue
+        # Every value of the bucket gets the average rank of the bucket
+        rank_sum_a += count_a * (seen + (tied + 1) / 2)
+        tie_term += tied ** 3 - tied
+        seen += tied
+
+    u_a = rank_sum_a - n_a * (n_a + 1) / 2
+    n = n_a + n_b
+    variance = n_a * n_b / 12 * ((n + 1) - tie_term / (n * (n - 1))) if n > 1 else 0
+    if variance <= 0:
+        return u_a / (n_a * n_b), 1.0
+    z = (u_a - n_a * n_b / 2) / math.sqrt(variance)
+    return u_a / (n_a * n_b), normal_two_sided_p(z)
+
+def percentile_confidence_interval(histogram, percentile):
+    """
+    Distribution-free 95% confidence interval of a percentile from the order statistics
+    Returns:
+        (low, high) latency in seconds, None if nothing was recorded
+    """
+    n = histogram.total_count
+    if not n:
+        return None
+    q = percentile / 100
+    spread = Z_95 * math.sqrt(n * q * (1 - q))
+    return (histogram.value_at_rank(math.floor(n * q - spread)),
+            histogram.value_at_rank(math.ceil(n * q + spread) + 1))
+
+def compare_latency_lines(stats_a, stats_b):
+    """
+    Format the comparison of the latency distributions of two runs of an endpoint
+    Returns:
+        List of lines
+    """
+    lines = []
+    for percentile in (50, 90, 99):
+        interval_a = percentile_confidence_interval(stats_a.histogram, percentile)
+        interval_b = percentile_confidence_interval(stats_b.histogram, percentile)
+        if interval_a is None or interval_b is None:
+            continue
+        value_a = stats_a.histogram.percentile(percentile)
+        value_b = stats_b.histogram.percentile(percentile)
+        # Non-overlapping intervals mean the percentile moved beyond the sampling noise
+        overlap = interval_a[0] <= interval_b[1] and interval_b[0] <= interval_a[1]
+        lines.append(
+            f"    p{percentile}: {value_a * 1000:.1f}ms [{interval_a[0] * 1000:.1f}, {interval_a[1] * 1000:.1f}] -> "
+            f"{value_b * 1000:.1f}ms [{interval_b[0] * 1000:.1f}, {interval_b[1] * 1000:.1f}] "
+            f"({(value_b - value_a) / value_a:+.1%}){'' if overlap else '  significant'}"
+        )
+
+    superiority, p_value = mann_whitney_u(stats_b.histogram, stats_a.histogram)
+    if p_value is not None:
+        verdict = "no significant difference"
+        if p_value < SIGNIFICANCE_LEVEL:
+            verdict = "slower" if superiority > 0.5 else "faster"
+        lines.append(f"    Distribution (Mann-Whitney U): P(new > old) = {superiority:.3f}, p = {p_value:.3g} -> {verdict}")
+    return lines
+
+def compare_throughput_lines(stats_a, stats_b):
+    """
+    Format the comparison of the per-second throughput of two runs of an endpoint
+    Returns:
+        List of lines
+    """
+    samples_a, samples_b = stats_a.throughput_samples(), stats_b.throughput_samples()
+    if len(samples_a) < 2 or len(samples_b) < 2:
+        return ["    Throughput: runs too short for a per-second comparison"]
+    mean_a, half_a = mean_confidence_interval(samples_a)
+    mean_b, half_b = mean_confidence_interval(samples_b)
+    p_value = welch_t_test(samples_a, samples_b)
+    verdict = "significant" if p_value < SIGNIFICANCE_LEVEL else "not significant"
+    return [
+        f"    Throughput: {mean_a:.1f} ± {half_a:.1f} -> {mean_b:.1f} ± {half_b:.1f} req/s "
+        f"({(mean_b - mean_a) / mean_a:+.1%}), Welch t-test p = {p_value:.3g} ({verdict})"
+    ]
+
+def compare_error_lines(stats_a, stats_b):
+    """
+    Format the comparison of the error rates of two runs with a two-proportion z-test
+    Returns:
+        List of lines
+    """
+    n_a, n_b = stats_a.requests, stats_b.requests
+    if not n_a or not n_b:
+        return []
+    rate_a, rate_b = stats_a.error_count / n_a, stats_b.error_count / n_b
+    pooled = (stats_a.error_count + stats_b.error_count) / (n_a + n_b)
+    line = f"    Error rate: {rate_a:.3%} -> {rate_b:.3%}"
+    if 0 < pooled < 1:
+        z = (rate_b - rate_a) / math.sqrt(pooled * (1 - pooled) * (1 / n_a + 1 / n_b))
+        line += f", p = {normal_two_sided_p(z):.3g}"
+    return [line]
+
+def metadata_diff_lines(metadata_a, metadata_b):
+    """
+    Format the settings that differ between two runs
+    Returns:
+        List of lines
+    """
+    lines = []
+    for key in sorted(set(metadata_a) | set(metadata_b)):
+        if key in ("client_host", "python", "label"):
+            continue
+        if metadata_a.get(key) != metadata_b.get(key):
+            lines.append(f"  {key}: {metadata_a.get(key)} -> {metadata_b.get(key)}")
+    return lines
+
+def compare_runs(run_a, run_b):
+    """
+    Format the comparison of two runs, run_a being the reference
+    Returns:
+        List of lines
+    """
+    lines = [f"Comparing {run_b['id']} against {run_a['id']}"]
+    differences = metadata_diff_lines(run_a["metadata"], run_b["metadata"])
+    if differences:
+        lines.append("Settings that changed:")
+        lines += differences
+
+    for name, stats_a in run_a["endpoints"].items():
+        stats_b = run_b["endpoints"].get(name)
+        if stats_b is None:
+            continue
+        lines.append(f"{name}: {stats_a.requests} -> {stats_b.requests} requests")
+        lines += compare_latency_lines(stats_a, stats_b)
+        lines += compare_throughput_lines(stats_a, stats_b)
+        lines += compare_error_lines(stats_a, stats_b)
+
+    for path, steps_a in run_a["steps"].items():
+        steps_b = run_b["steps"].get(path)
+        if not steps_b:
+            continue
+        p99_threshold = run_a["metadata"].get("p99_threshold", 500) / 1000
+        max_error_rate = run_a["metadata"].get("max_error_rate", 0.001)
+        knee_a = find_knee(steps_a, p99_threshold, max_error_rate)
+        knee_b = find_knee(steps_b, p99_threshold, max_error_rate)
+        lines.append(f"{path}: knee {knee_a} -> {knee_b} req/s")
+        steps_b_by_rps = dict(steps_b)
+        for rps, stats_a in steps_a:
+            if rps in steps_b_by_rps:
+                lines.append(f"  Step {rps:g} req/s:")
+                lines += compare_latency_lines(stats_a, steps_b_by_rps[rps])
+    return lines
+
+def list_runs(directory):
+    """
+    Print the saved runs
+    """
+    if not os.path.isdir(directory):
+        print(f"No runs saved in {directory}.")
+        return
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith(".json"):
+            continue
+        with open(os.path.join(directory, file_name)) as file:
+            run = json.load(file)
+        metadata = run["metadata"]
+        endpoints = ", ".join(
+            f"{endpoint['stats']['name']} {endpoint['stats']['histogram']['total_count']} requests"
+            for endpoint in run["endpoints"]
+        ) or ", ".join(run["steps"])
+        print(f"{run['id']}: {metadata.get('profile')} profile on {metadata.get('target')} "
+              f"(commit {str(metadata.get('server_commit'))[:12]}) - {endpoints}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Browse and compare saved benchmark runs")
+    parser.add_argument("--dir", default=RUNS_DIRECTORY, help="directory of the run history")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="list the saved runs")
+    baseline_parser = subparsers.add_parser("baseline", help="set the run the others are compared against")
+    baseline_parser.add_argument("run", help="run id or file")
+    compare_parser = subparsers.add_parser("compare", help="compare two runs")
+    compare_parser.add_argument("run", help="run id or file to check")
+    compare_parser.add_argument("reference", nargs="?", default="baseline",
+                                help="run id or file it is compared against (default: the baseline)")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "list":
+        list_runs(args.dir)
+    elif args.command == "baseline":
+        run_path = resolve_run(args.dir, args.run)
+        with open(os.path.join(args.dir, BASELINE_FILE), "w") as file:
+            file.write(os.path.abspath(run_path))
+        print(f"Baseline set to {run_path}")
+    else:
+        reference = load_run(resolve_run(args.dir, args.reference))
+        run = load_run(resolve_run(args.dir, args.run))
+        print("\n".join(compare_runs(reference, run)))
@@ -0,0 +1,170 @@
+import asyncio
+import json
+import math
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+# Header of the binary format, followed by one JSON line listing the endpoints
+BINARY_MAGIC = b"BENCHRES2\n"
+
+# timestamp (epoch seconds), latency (seconds), status (0 when no response), endpoint index, instance number (0 when unknown),
+# server queue and handler times from Server-Timing (seconds, NaN when the response had none)
+BINARY_RECORD = struct.Struct("<dfHBHff")
+
+# First version of the binary format, without the server times, still readable
+BINARY_MAGIC_V1 = b"BENCHRES1\n"
+BINARY_RECORD_V1 = struct.Struct("<dfHBH")
+
+class ResultSink:
+    """
+    Buffered writer of per-request results.
+    Records are appended to an in-memory buffer and every full batch is encoded and written
+    by a single background thread, so the event loop never blocks on file I/O.
+    Supported formats are "jsonl" (one JSON object per line) and "binary" (fixed-size records).
+    """
+
+    def __init__(self, path, fmt, endpoints, batch_size=1000):
+        """
+        Args:
+            path: output file, results are appended to it
+            fmt: "jsonl" or "binary"
+            endpoints: list of every endpoint that can be written
+            batch_size: number of records buffered before a write
+        """
+        self.fmt = fmt
+        self.endpoints = list(endpoints)
+        self.endpoint_index = {endpoint: index for index, endpoint in enumerate(self.endpoints)}
+        self.batch_size = batch_size
+        self.buffer = []
+        self.pending = []
+        check_existing_file(path, fmt, self.endpoints)
+        self.file = open(path, "ab")
+        # A single thread keeps the batches in order
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        if fmt == "binary" and self.file.tell() == 0:
+            self.file.write(BINARY_MAGIC + json.dumps(self.endpoints).encode() + b"\n")
+
+    def write(self, timestamp, endpoint, status, latency, instance, request_id=None, server_timing=None):
+        """
+        Add the result of a request
+        Args:
+            timestamp: epoch time at which the request was scheduled
+            endpoint: path of the endpoint
+            status: HTTP status, None if no response was received
+            latency: latency in seconds
+            instance: number of the instance that answered, None if unknown
+            request_id: X-Request-ID sent with the request, only kept in the jsonl format
+            server_timing: dictionary of the Server-Timing durations in seconds, None if the response had none
+        """
+        self.buffer.append((timestamp, endpoint, status, latency, instance, request_id, server_timing or {}))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Hand the buffered records to the writer thread
+        """
+        if not self.buffer:
+            return
+        batch, self.buffer = self.buffer, []
+        self.pending = [future for future in self.pending if not future.done()]
+        self.pending.append(self.executor.submit(self._write_batch, batch))
+
+    def _write_batch(self, batch):
+        if self.fmt == "binary":
+            data = b"".join(
+                BINARY_RECORD.pack(
+                    timestamp, latency, status or 0, self.endpoint_index[endpoint],
+                    int(instance) if instance and instance.isdigit() else 0,
+                    timing.get("queue", math.nan), timing.get("handler", math.nan),
+                )
+                for timestamp, endpoint, status, latency, instance, _, timing in batch
+            )
+        else:
+            data = "".join(
+                json.dumps({
+                    "timestamp": round(timestamp, 6),
+                    "endpoint": endpoint,
+                    "status": status,
+                    "latency": round(latency, 6),
+                    "instance": instance,
+                    "request_id": request_id,
+                    "server_queue": timing.get("queue"),
+                    "server_handler": timing.get("handler"),
+                }) + "\n"
+                for timestamp, endpoint, status, latency, instance, request_id, timing in batch
+            ).encode()
+        self.file.write(data)
+
+    async def close(self):
+        """
+        Write the remaining records and close the file
+        """
+        self.flush()
+        for future in self.pending:
+            await asyncio.wrap_future(future)
+        self.executor.shutdown()
+        self.file.close()
+
+
+def check_existing_file(path, fmt, endpoints):
+    """
+    Check that results can be appended to a file: it must be empty or written in the same format,
+    and a binary file must use the current version and the same endpoints, since the records only store their index
+    Args:
+        path: result file
+        fmt: "jsonl" or "binary"
+        endpoints: list of the endpoints of the new records
+    """
+    try:
+        with open(path, "rb") as file:
+            magic = file.read(len(BINARY_MAGIC))
+            header = file.readline()
+    except FileNotFoundError:
+        return
+    if not magic:
+        return
+    if magic in (BINARY_MAGIC, BINARY_MAGIC_V1):
+        if fmt != "binary":
+            raise ValueError(f"{path} holds binary results, cannot append {fmt} results to it")
+        if magic != BINARY_MAGIC:
+            raise ValueError(f"{path} uses an older version of the binary format, write the results to a new file")
+        if json.loads(header) != endpoints:
+            raise ValueError(f"{path} was written for other endpoints, write the results to a new file")
+    elif fmt == "binary":
+        raise ValueError(f"{path} is not a binary result file, cannot append binary results to it")
+
+def read_results(path):
+    """
+    Read a result file written by ResultSink
+    Args:
+        path: result file in either format
+    Returns:
+        Generator of dictionaries with the fields of every record
+    """
+    with open(path, "rb") as file:
+        magic = file.read(len(BINARY_MAGIC))
+        if magic not in (BINARY_MAGIC, BINARY_MAGIC_V1):
+            file.seek(0)
+            for line in file:
+                yield json.loads(line)
+            return
+
+        record = BINARY_RECORD if magic == BINARY_MAGIC else BINARY_RECORD_V1
+        endpoints = json.loads(file.readline())
+        while True:
+            data = file.read(record.size)
+            if len(data) < record.size:
+                return
+            timestamp, latency, status, endpoint, instance, *timing = record.unpack(data)
+            result = {
+                "timestamp": timestamp,
+                "endpoint": endpoints[endpoint],
+                "status": status or None,
+                "latency": latency,
+                "instance": str(instance) if instance else None,
+            }
+            if timing:
+                result["server_queue"] = None if math.isnan(timing[0]) else timing[0]
+                result["server_handler"] = None if math.isnan(timing[1]) else timing[1]
+            yield result
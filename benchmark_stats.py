@@ -0,0 +1,503 @@
+import math
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+# Below this fairness index the report warns that the load is concentrated on a few backends
+FAIRNESS_WARNING = 0.8
+
+# Key of the results whose payload did not identify an instance (load balancer errors, timeouts...)
+UNKNOWN_BACKEND = "unknown"
+
+def jain_fairness(values):
+    """
+    Jain's fairness index of a load distribution: 1 when every backend gets the same share,
+    1/n when a single backend out of n gets everything
+    Args:
+        values: load of every backend
+    Returns:
+        Index between 1/n and 1, None without values
+    """
+    total = sum(values)
+    squares = sum(value * value for value in values)
+    if not values or not squares:
+        return None
+    return total * total / (len(values) * squares)
+
+class LatencyHistogram:
+    """
+    HDR-style latency histogram with a fixed memory footprint.
+    Values are recorded in microseconds into log-linear buckets: every power of two
+    is split into the same number of linear sub-buckets, which bounds the relative
+    error of a reported value to 1 / 2**(sub_bucket_bits - 1).
+    Histograms with the same settings can be merged by adding their counts.
+    """
+
+    def __init__(self, sub_bucket_bits=8, max_value_us=120_000_000):
+        """
+        Args:
+            sub_bucket_bits: precision of the histogram (8 bits is below 1% error)
+            max_value_us: largest trackable value, bigger values go to the last bucket
+        """
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_bucket_count = 1 << sub_bucket_bits
+        self.half_count = self.sub_bucket_count // 2
+        self.max_value_us = max_value_us
+        self.counts = [0] * (self._index(max_value_us) + 1)
+        self.total_count = 0
+        self.min_us = None
+        self.max_us = 0
+
+    def _index(self, value_us):
+        """
+        Get the bucket index of a value
+        """
+        if value_us < self.sub_bucket_count:
+            return value_us
+        shift = value_us.bit_length() - self.sub_bucket_bits
+        return self.sub_bucket_count + (shift - 1) * self.half_count + (value_us >> shift) - self.half_count
+
+    def _highest_value(self, index):
+        """
+        Get the highest value that falls into a bucket
+        """
+        if index < self.sub_bucket_count:
+            return index
+        shift = (index - self.sub_bucket_count) // self.half_count + 1
+        top = (index - self.sub_bucket_count) % self.half_count + self.half_count
+        return ((top + 1) << shift) - 1
+
+    def record(self, seconds):
+        """
+        Record a latency
+        Args:
+            seconds: latency in seconds
+        """
+        value_us = max(0, int(seconds * 1_000_000))
+        self.counts[self._index(min(value_us, self.max_value_us))] += 1
+        self.total_count += 1
+        self.max_us = max(self.max_us, value_us)
+        self.min_us = value_us if self.min_us is None else min(self.min_us, value_us)
+
+    def merge(self, other):
+        """
+        Add the recorded values of another histogram with the same settings
+        Args:
+            other: LatencyHistogram to merge into this one
+        """
+        if other.sub_bucket_bits != self.sub_bucket_bits or other.max_value_us != self.max_value_us:
+            raise ValueError("Cannot merge histograms with different settings")
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.total_count += other.total_count
+        self.max_us = max(self.max_us, other.max_us)
+        if other.min_us is not None:
+            self.min_us = other.min_us if self.min_us is None else min(self.min_us, other.min_us)
+
+    def percentile(self, percentile):
+        """
+        Get the value at a percentile
+        Args:
+            percentile: percentile between 0 and 100
+        Returns:
+            Latency in seconds, None if nothing was recorded
+        """
+        if not self.total_count:
+            return None
+        return self.value_at_rank(math.ceil(percentile / 100 * self.total_count))
+
+    def value_at_rank(self, rank):
+        """
+        Get the value of the rank-th smallest recorded value
+        Args:
+            rank: rank starting at 1, clamped to the recorded range
+        Returns:
+            Latency in seconds, None if nothing was recorded
+        """
+        if not self.total_count:
+            return None
+        rank = min(max(1, rank), self.total_count)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._highest_value(index), self.max_us) / 1_000_000
+        return self.max_us / 1_000_000
+
+    def mean(self):
+        """
+        Get the mean of the recorded values (within the histogram precision)
+        Returns:
+            Mean latency in seconds, None if nothing was recorded
+        """
+        if not self.total_count:
+            return None
+        total = sum(min(self._highest_value(index), self.max_us) * count
+                    for index, count in enumerate(self.counts) if count)
+        return total / self.total_count / 1_000_000
+
+    def to_dict(self):
+        """
+        Serialize the histogram, only non-empty buckets are kept
+        """
+        return {
+            "sub_bucket_bits": self.sub_bucket_bits,
+            "max_value_us": self.max_value_us,
+            "total_count": self.total_count,
+            "min_us": self.min_us,
+            "max_us": self.max_us,
+            "counts": {str(index): count for index, count in enumerate(self.counts) if count},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Rebuild a histogram serialized with to_dict
+        """
+        histogram = cls(data["sub_bucket_bits"], data["max_value_us"])
+        for index, count in data["counts"].items():
+            histogram.counts[int(index)] = count
+        histogram.total_count = data["total_count"]
+        histogram.min_us = data["min_us"]
+        histogram.max_us = data["max_us"]
+        return histogram
+
+
+class EndpointStats:
+    """
+    Latency histogram and error counts of the requests sent to one endpoint,
+    with the same statistics split by the backend instance that answered
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.histogram = LatencyHistogram()
+        self.errors = {}
+        self.elapsed = 0.0
+        self.backends = {}
+        # Completed requests per epoch second, the throughput time series of the run
+        self.completions = {}
+        # Requests waiting for a response, only meaningful while the benchmark runs
+        self.in_flight = 0
+        # Latency split of the responses with a Server-Timing header: time waiting for admission in the server,
+        # time in the handler, and the rest (network, load balancer and client)
+        self.server_queue = LatencyHistogram()
+        self.server_handler = LatencyHistogram()
+        self.outside_server = LatencyHistogram()
+        # Responses that did not echo the X-Request-ID, e.g. error pages of the load balancer
+        self.unechoed = 0
+
+    @property
+    def requests(self):
+        return self.histogram.total_count
+
+    @property
+    def error_count(self):
+        return sum(self.errors.values())
+
+    def record(self, latency, status_code, error=None, backend=None, completed_at=None, server_timing=None):
+        """
+        Record the result of a request, failed requests are timed too
+        Args:
+            latency: latency in seconds
+            status_code: HTTP status, None if no response was received
+            error: exception raised by the request
+            backend: instance that answered, None if the response did not say
+            completed_at: epoch time at which the response was received
+            server_timing: dictionary of the Server-Timing durations in seconds, None if the response had none
+        """
+        self._record_totals(latency, status_code, error)
+        if completed_at is not None:
+            second = int(completed_at)
+            self.completions[second] = self.completions.get(second, 0) + 1
+        if server_timing and "handler" in server_timing:
+            queue = server_timing.get("queue", 0.0)
+            self.server_queue.record(queue)
+            self.server_handler.record(server_timing["handler"])
+            self.outside_server.record(max(0.0, latency - queue - server_timing["handler"]))
+
+        if backend is None:
+            backend = UNKNOWN_BACKEND
+        if backend not in self.backends:
+            self.backends[backend] = EndpointStats(backend)
+        self.backends[backend]._record_totals(latency, status_code, error)
+
+    def _record_totals(self, latency, status_code, error):
+        self.histogram.record(latency)
+        if status_code != 200:
+            kind = f"HTTP {status_code}" if status_code is not None else type(error).__name__
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def merge(self, other):
+        """
+        Add the results of another EndpointStats
+        """
+        self.histogram.merge(other.histogram)
+        for kind, count in other.errors.items():
+            self.errors[kind] = self.errors.get(kind, 0) + count
+        self.elapsed = max(self.elapsed, other.elapsed)
+        for backend, backend_stats in other.backends.items():
+            if backend not in self.backends:
+                self.backends[backend] = EndpointStats(backend)
+            self.backends[backend].merge(backend_stats)
+        for second, count in other.completions.items():
+            self.completions[second] = self.completions.get(second, 0) + count
+        self.server_queue.merge(other.server_queue)
+        self.server_handler.merge(other.server_handler)
+        self.outside_server.merge(other.outside_server)
+        self.unechoed += other.unechoed
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "histogram": self.histogram.to_dict(),
+            "errors": dict(self.errors),
+            "elapsed": self.elapsed,
+            "backends": {backend: stats.to_dict() for backend, stats in self.backends.items()},
+            "completions": {str(second): count for second, count in self.completions.items()},
+            "server_timing": {
+                "queue": self.server_queue.to_dict(),
+                "handler": self.server_handler.to_dict(),
+                "outside": self.outside_server.to_dict(),
+            },
+            "unechoed": self.unechoed,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls(data["name"])
+        stats.histogram = LatencyHistogram.from_dict(data["histogram"])
+        stats.errors = dict(data["errors"])
+        stats.elapsed = data["elapsed"]
+        stats.backends = {backend: cls.from_dict(backend_data) for backend, backend_data in data.get("backends", {}).items()}
+        stats.completions = {int(second): count for second, count in data.get("completions", {}).items()}
+        if "server_timing" in data:
+            stats.server_queue = LatencyHistogram.from_dict(data["server_timing"]["queue"])
+            stats.server_handler = LatencyHistogram.from_dict(data["server_timing"]["handler"])
+            stats.outside_server = LatencyHistogram.from_dict(data["server_timing"]["outside"])
+        stats.unechoed = data.get("unechoed", 0)
+        return stats
+
+    def throughput_samples(self):
+        """
+        Get the number of requests completed in every full second of the run,
+        the first and last seconds are partial and left out
+        Returns:
+            List of requests per second
+        """
+        if len(self.completions) < 3:
+            return []
+        first, last = min(self.completions), max(self.completions)
+        return [self.completions.get(second, 0) for second in range(first + 1, last)]
+
+    def fairness(self, expected_backends=None):
+        """
+        Get how evenly the identified backends shared the requests
+        Args:
+            expected_backends: number of instances in the target group, the ones that never
+                answered count as receiving nothing
+        Returns:
+            Jain's fairness index, None if no backend was identified
+        """
+        counts = [stats.requests for backend, stats in self.backends.items() if backend != UNKNOWN_BACKEND]
+        if expected_backends and expected_backends > len(counts):
+            counts += [0] * (expected_backends - len(counts))
+        return jain_fairness(counts)
+
+    def latency_text(self):
+        """
+        Format the latency percentiles
+        """
+        values = [f"p{p:g}={self.histogram.percentile(p) * 1000:.1f}ms" for p in PERCENTILES]
+        values.append(f"max={self.histogram.max_us / 1000:.1f}ms")
+        return f"mean={self.histogram.mean() * 1000:.1f}ms " + " ".join(values)
+
+    def summary_lines(self, expected_backends=None):
+        """
+        Format the report of the endpoint
+        Args:
+            expected_backends: number of instances in the target group, for the fairness index
+        Returns:
+            List of lines
+        """
+        lines = [f"{self.name}: {self.requests} requests, {self.error_count} errors"]
+        if self.elapsed:
+            lines.append(f"  Throughput: {self.requests / self.elapsed:.1f} req/s over {self.elapsed:.2f} seconds")
+        if self.requests:
+            lines.append(f"  Latency: {self.latency_text()}")
+        lines += self.breakdown_lines()
+        for kind, count in sorted(self.errors.items()):
+            lines.append(f"  {kind}: {count}")
+        lines += self.backend_lines(expected_backends)
+        return lines
+
+    def breakdown_lines(self):
+        """
+        Format where the time of the requests went, from the Server-Timing headers
+        Returns:
+            List of lines
+        """
+        timed = self.server_handler.total_count
+        lines = []
+        if timed:
+            parts = [
+                ("queue in the server", self.server_queue),
+                ("handler", self.server_handler),
+                ("outside the server (network, load balancer, client)", self.outside_server),
+            ]
+            lines.append(f"  Breakdown of the {timed} responses with Server-Timing (p50 / p99):")
+            for label, histogram in parts:
+                lines.append(f"    {label}: {histogram.percentile(50) * 1000:.2f}ms / {histogram.percentile(99) * 1000:.2f}ms")
+        if self.unechoed:
+            lines.append(f"  {self.unechoed} responses did not echo the request ID (not answered by the app)")
+        return lines
+
+    def backend_lines(self, expected_backends=None):
+        """
+        Format the load distribution and the statistics of every backend
+        Args:
+            expected_backends: number of instances in the target group, for the fairness index
+        Returns:
+            List of lines
+        """
+        identified = {backend: stats for backend, stats in self.backends.items() if backend != UNKNOWN_BACKEND}
+        if not identified:
+            return []
+
+        seen = f"{len(identified)} seen" + (f" of {expected_backends}" if expected_backends else "")
+        busiest = max(identified.values(), key=lambda stats: stats.requests)
+        fairness = self.fairness(expected_backends)
+        lines = [
+            f"  Backends: {seen}, Jain fairness {fairness:.3f}, busiest is instance "
+            f"{busiest.name} with {busiest.requests / self.requests:.1%} of the requests"
+        ]
+        if fairness < FAIRNESS_WARNING:
+            lines.append("  Warning: the load is concentrated on a few backends")
+        # Numbered instances first in numeric order, then the unknown bucket
+        ordered = sorted(self.backends.items(), key=lambda item: (
+            item[0] == UNKNOWN_BACKEND, not item[0].isdigit(), int(item[0]) if item[0].isdigit() else 0, item[0]
+        ))
+        for backend, stats in ordered:
+            label = "Unidentified" if backend == UNKNOWN_BACKEND else f"Instance {backend}"
+            lines.append(
+                f"    {label}: {stats.requests} requests ({stats.requests / self.requests:.1%}), "
+                f"{stats.error_count} errors ({stats.error_count / stats.requests:.1%}), {stats.latency_text()}"
+            )
+        return lines
+
+
+class ConnectionStats:
+    """
+    Connection pool activity of a client session, collected through aiohttp tracing:
+    how many connections were opened for how many requests and where the time went
+    """
+
+    FIELDS = (
+        "requests", "connections_opened", "connections_reused",
+        "dns_time", "pool_wait_time", "connect_time", "request_time",
+    )
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def merge(self, other):
+        """
+        Add the activity of another ConnectionStats
+        """
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        for field in cls.FIELDS:
+            setattr(stats, field, data[field])
+        return stats
+
+    def summary_lines(self):
+        """
+        Format the report of the connection pool
+        Returns:
+            List of lines
+        """
+        if not self.requests:
+            return ["  Connections: no requests traced"]
+
+        def per_request(seconds):
+            return f"{seconds / self.requests * 1000:.2f}ms/request"
+
+        return [
+            f"  Connections: {self.connections_opened} opened, {self.connections_reused} reused "
+            f"for {self.requests} requests ({self.connections_opened / self.requests:.2f} connections/request)",
+            f"    DNS: {per_request(self.dns_time)} - Pool wait: {per_request(self.pool_wait_time)} - "
+            f"Connect: {per_request(self.connect_time)} - Request until headers: {per_request(self.request_time)}",
+        ]
+
+
+def step_passes(stats, p99_threshold, max_error_rate):
+    """
+    Check whether a load step stayed within the latency and error objectives
+    Args:
+        stats: EndpointStats of the step
+        p99_threshold: highest acceptable p99 latency in seconds
+        max_error_rate: highest acceptable share of failed requests
+    Returns:
+        True if the step met both objectives
+    """
+    if not stats.requests:
+        return False
+    return stats.histogram.percentile(99) <= p99_threshold and stats.error_count / stats.requests <= max_error_rate
+
+def find_knee(steps, p99_threshold, max_error_rate):
+    """
+    Find the saturation point of a step profile: the highest request rate at which
+    every step up to it kept its p99 latency and error rate within the objectives
+    Args:
+        steps: list of (target rps, EndpointStats) in increasing rps order
+        p99_threshold: highest acceptable p99 latency in seconds
+        max_error_rate: highest acceptable share of failed requests
+    Returns:
+        Target rps of the knee, None if even the first step failed
+    """
+    knee = None
+    for rps, stats in steps:
+        if not step_passes(stats, p99_threshold, max_error_rate):
+            break
+        knee = rps
+    return knee
+
+def step_profile_lines(name, steps, p99_threshold, max_error_rate):
+    """
+    Format the report of a step profile
+    Args:
+        name: path of the endpoint
+        steps: list of (target rps, EndpointStats)
+        p99_threshold: highest acceptable p99 latency in seconds
+        max_error_rate: highest acceptable share of failed requests
+    Returns:
+        List of lines
+    """
+    lines = [f"{name}: step profile (p99 <= {p99_threshold * 1000:.0f}ms, error rate <= {max_error_rate:.2%})",
+             f"  {'target':>8} {'achieved':>9} {'p50':>9} {'p99':>9} {'errors':>8}"]
+    for rps, stats in steps:
+        if not stats.requests:
+            lines.append(f"  {rps:>8.1f} {'-':>9} {'-':>9} {'-':>9} {'-':>8}  FAIL")
+            continue
+        status = "ok" if step_passes(stats, p99_threshold, max_error_rate) else "FAIL"
+        lines.append(
+            f"  {rps:>8.1f} {stats.requests / stats.elapsed:>9.1f} "
+            f"{stats.histogram.percentile(50) * 1000:>7.1f}ms {stats.histogram.percentile(99) * 1000:>7.1f}ms "
+            f"{stats.error_count / stats.requests:>8.2%}  {status}"
+        )
+    knee = find_knee(steps, p99_threshold, max_error_rate)
+    if knee is None:
+        lines.append("  Knee: the first step already missed the objectives")
+    elif knee == steps[-1][0] and step_passes(steps[-1][1], p99_threshold, max_error_rate):
+        lines.append(f"  Knee: not reached, every step up to {knee:g} req/s met the objectives")
+    else:
+        lines.append(f"  Knee: {knee:g} req/s")
+    return lines
@@ -0,0 +1,104 @@
+import json
+import os
+
+DEFAULT_HEADERS = {"content-type": "application/json"}
+
+# Built-in workloads, a workload file uses the same format:
+# {"name": ..., "concurrency": max requests in flight or null, "endpoints": [{"path", "weight", "headers", "method"}]}
+WORKLOADS = {
+    "cluster1": {"name": "cluster1", "concurrency": None, "endpoints": [{"path": "/cluster1", "weight": 1}]},
+    "cluster2": {"name": "cluster2", "concurrency": None, "endpoints": [{"path": "/cluster2", "weight": 1}]},
+    "mixed": {
+        "name": "mixed",
+        "concurrency": None,
+        "endpoints": [
+            {"path": "/cluster1", "weight": 0.7},
+            {"path": "/cluster2", "weight": 0.3},
+        ],
+    },
+    # Requests with a real cost: 10 ms of CPU on the instances of both clusters (see the work routes of my_fastapi.py)
+    "cpu": {
+        "name": "cpu",
+        "concurrency": None,
+        "endpoints": [
+            {"path": "/cluster1/work/cpu?ms=10", "weight": 1},
+            {"path": "/cluster2/work/cpu?ms=10", "weight": 1},
+        ],
+    },
+}
+
+def normalize_workload(workload):
+    """
+    Check a workload definition and fill in the defaults
+    Args:
+        workload: workload dictionary
+    Returns:
+        Workload dictionary where every endpoint has a path, weight, headers and method
+    """
+    endpoints = workload.get("endpoints")
+    if not endpoints:
+        raise ValueError("A workload needs at least one endpoint")
+
+    normalized = []
+    for endpoint in endpoints:
+        if not str(endpoint.get("path", "")).startswith("/"):
+            raise ValueError(f"Invalid endpoint path: {endpoint.get('path')}")
+        weight = float(endpoint.get("weight", 1))
+        if weight <= 0:
+            raise ValueError(f"The weight of {endpoint['path']} must be positive")
+        normalized.append({
+            "path": endpoint["path"],
+            "weight": weight,
+            "headers": dict(DEFAULT_HEADERS, **endpoint.get("headers", {})),
+            "method": endpoint.get("method", "GET").upper(),
+        })
+
+    paths = [endpoint["path"] for endpoint in normalized]
+    if len(set(paths)) != len(paths):
+        raise ValueError("Every endpoint of a workload needs its own path")
+
+    concurrency = workload.get("concurrency")
+    return {
+        "name": workload.get("name", "custom"),
+        "concurrency": int(concurrency) if concurrency else None,
+        "endpoints": normalized,
+    }
+
+def load_workload(name):
+    """
+    Get a built-in workload or read one from a JSON file
+    Args:
+        name: name of a built-in workload or path of a workload file
+    Returns:
+        Normalized workload dictionary
+    """
+    if name in WORKLOADS:
+        return normalize_workload(WORKLOADS[name])
+    if not os.path.isfile(name):
+        raise ValueError(f"Unknown workload {name}, use one of {', '.join(WORKLOADS)} or a JSON file")
+    with open(name) as file:
+        workload = json.load(file)
+    workload.setdefault("name", os.path.splitext(os.path.basename(name))[0])
+    return normalize_workload(workload)
+
+def assign_endpoints(workload, count):
+    """
+    Pick the endpoint of every request so that the traffic mix follows the weights exactly
+    and the endpoints are interleaved (smooth weighted round-robin)
+    Args:
+        workload: normalized workload
+        count: number of requests
+    Returns:
+        List of endpoint indexes
+    """
+    weights = [endpoint["weight"] for endpoint in workload["endpoints"]]
+    total = sum(weights)
+    current = [0.0] * len(weights)
+    assignment = []
+    for _ in range(count):
+        for index, weight in enumerate(weights):
+            current[index] += weight
+        chosen = max(range(len(weights)), key=current.__getitem__)
+        current[chosen] -= total
+        assignment.append(chosen)
+    return assignment
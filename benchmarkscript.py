@@ -1,35 +1,156 @@
+import argparse
 import asyncio
 import aiohttp
+import json
+import os
+import random
+import re
 import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from benchmark_history import RUNS_DIRECTORY, save_run
+from benchmark_sink import ResultSink
+from benchmark_stats import ConnectionStats, EndpointStats, step_passes, step_profile_lines
+from benchmark_workload import WORKLOADS, assign_endpoints, load_workload
+from local_cluster import LocalCluster
+from server_metrics import histogram_quantile, parse_metrics, route_latency, subtract_latency
 
-async def call_endpoint_http1 (session, request_num, dns_name):
-    url = f"http://{dns_name}:8000/cluster1"
-    headers = {"content-type":"application/json"}
-    
+async def call_endpoint(session, url, method, headers):
+    """
+    Send one request
+    Args:
+        session: aiohttp client session
+        url: url of the endpoint
+        method: HTTP method
+        headers: request headers
+    Returns:
+        Status code (None if the request failed), the decoded JSON payload (the exception on failure)
+        and the response headers (None on failure)
+    """
     try:
-        async with session.get(url, headers = headers) as response:
-            status_code = response.status
-            response_json = await response.json()
-            print (f"Request{ request_num }:Status Code:{ status_code}")
-            return status_code, response_json
-    except Exception as e :
-        print(f"Request{ request_num }:Failed - {str(e)}")
-        return None, str(e)
+        async with session.request(method, url, headers=headers) as response:
+            body = await response.read()
+            try:
+                return response.status, json.loads(body), response.headers
+            except ValueError:
+                # Error pages of the load balancer are not JSON, the status is what matters
+                return response.status, None, response.headers
+    except Exception as e:
+        return None, e, None
 
+# Instance type, path and number of instances of each cluster, as launched by start.py
+CLUSTERS = (
+    ("t2.micro", "/cluster1", 5),
+    ("t2.large", "/cluster2", 4),
+)
 
-async def call_endpoint_http2(session, request_num, dns_name):
-    url = f"http://{dns_name}:8000/cluster2"
-    headers = {"content-type": "application/json"}
+# Named TCPConnector settings, "default" matches what aiohttp picks when nothing is given.
+# keepalive_timeout is kept below the 60 seconds idle timeout of the ALB in the pooled profiles
+CONNECTOR_PROFILES = {
+    "default": {"limit": 100, "keepalive_timeout": 15, "force_close": False, "ttl_dns_cache": 10},
+    "pooled": {"limit": 1000, "keepalive_timeout": 55, "force_close": False, "ttl_dns_cache": 300},
+    "small-pool": {"limit": 20, "keepalive_timeout": 55, "force_close": False, "ttl_dns_cache": 300},
+    "no-reuse": {"limit": 1000, "keepalive_timeout": None, "force_close": True, "ttl_dns_cache": 10},
+    "no-dns-cache": {"limit": 100, "keepalive_timeout": 15, "force_close": False, "ttl_dns_cache": 0},
+}
 
-    try:
-        async with session.get(url, headers=headers) as response:
-            status_code = response.status
-            response_json = await response.json()
-            print(f"Request{request_num}:Status Code:{status_code}")
-            return status_code, response_json
-    except Exception as e:
-        print(f"Request{request_num}:Failed - {str(e)}")
-        return None, str(e)
+# The servers answer "Instance number N (Cluster K) has received request number M"
+INSTANCE_PATTERN = re.compile(r"Instance number (\S+) \(Cluster \d+\)")
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+# Seconds given to the worker processes to start before the shared start time
+WORKER_STARTUP_DELAY = 1.0
+
+def get_connector_settings(args):
+    """
+    Get the connector settings of the selected profile with the command line overrides applied
+    Args:
+        args: parsed command line arguments
+    Returns:
+        Dictionary of connector settings
+    """
+    settings = dict(CONNECTOR_PROFILES[args.connector])
+    overrides = {
+        "limit": args.pool_limit,
+        "keepalive_timeout": args.keepalive,
+        "force_close": args.force_close or None,
+        "ttl_dns_cache": args.dns_ttl,
+    }
+    settings.update({key: value for key, value in overrides.items() if value is not None})
+    return settings
+
+def create_connector(settings):
+    """
+    Create the TCPConnector of a client session
+    Args:
+        settings: connector settings from get_connector_settings
+    Returns:
+        aiohttp TCPConnector
+    """
+    kwargs = {
+        "limit": settings["limit"],
+        "force_close": settings["force_close"],
+        "ttl_dns_cache": settings["ttl_dns_cache"],
+        "use_dns_cache": settings["ttl_dns_cache"] != 0,
+    }
+    # aiohttp refuses a keep-alive timeout on connections that are closed after every request
+    if not settings["force_close"] and settings["keepalive_timeout"] is not None:
+        kwargs["keepalive_timeout"] = settings["keepalive_timeout"]
+    return aiohttp.TCPConnector(**kwargs)
+
+def create_trace_config(connections):
+    """
+    Create a trace config recording the connection pool activity of a session
+    Args:
+        connections: ConnectionStats receiving the activity
+    Returns:
+        aiohttp TraceConfig
+    """
+    def now():
+        return asyncio.get_running_loop().time()
+
+    async def on_request_start(session, ctx, params):
+        connections.requests += 1
+        ctx.request_start = now()
+
+    async def on_request_done(session, ctx, params):
+        connections.request_time += now() - ctx.request_start
+
+    async def on_dns_resolvehost_start(session, ctx, params):
+        ctx.dns_start = now()
+
+    async def on_dns_resolvehost_end(session, ctx, params):
+        connections.dns_time += now() - ctx.dns_start
+
+    async def on_connection_queued_start(session, ctx, params):
+        ctx.queued_start = now()
+
+    async def on_connection_queued_end(session, ctx, params):
+        connections.pool_wait_time += now() - ctx.queued_start
+
+    async def on_connection_create_start(session, ctx, params):
+        ctx.connect_start = now()
+
+    async def on_connection_create_end(session, ctx, params):
+        connections.connections_opened += 1
+        connections.connect_time += now() - ctx.connect_start
+
+    async def on_connection_reuseconn(session, ctx, params):
+        connections.connections_reused += 1
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_done)
+    trace_config.on_request_exception.append(on_request_done)
+    trace_config.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+    trace_config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+    trace_config.on_connection_queued_start.append(on_connection_queued_start)
+    trace_config.on_connection_queued_end.append(on_connection_queued_end)
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    return trace_config
 
 def get_load_balancer_dns():
     try:
@@ -40,35 +161,585 @@ def get_load_balancer_dns():
         print("DNS file not found.")
         return None
 
-async def main () :
+def build_schedule(num_requests, rps=None, duration=None, arrival="constant", seed=None):
+    """
+    Build the send offsets (seconds from the start of the run) of every request
+    Args:
+        num_requests: number of requests of a burst run (ignored when rps is set)
+        rps: target arrival rate, None for a burst where everything is sent at once
+        duration: length of an open-loop run in seconds
+        arrival: "constant" for evenly spaced arrivals or "poisson" for exponential gaps
+        seed: random seed of the poisson arrivals
+    Returns:
+        Sorted list of send offsets
+    """
+    if rps is None:
+        return [0.0] * num_requests
+
+    if arrival == "poisson":
+        rng = random.Random(seed)
+        offsets = []
+        offset = rng.expovariate(rps)
+        while offset < duration:
+            offsets.append(offset)
+            offset += rng.expovariate(rps)
+        return offsets
+
+    return [i / rps for i in range(int(rps * duration))]
+
+def build_workload_schedule(workload, num_requests, rps=None, duration=None, arrival="constant", seed=None):
+    """
+    Build the schedule of a workload: every request gets a send offset and an endpoint following the traffic mix
+    Args:
+        workload: normalized workload
+        num_requests, rps, duration, arrival, seed: see build_schedule, rates are for the whole mix
+    Returns:
+        List of (send offset, endpoint index)
+    """
+    offsets = build_schedule(num_requests, rps, duration, arrival, seed)
+    return list(zip(offsets, assign_endpoints(workload, len(offsets))))
+
+def get_instance_count(path):
+    """
+    Get the number of instances behind a path, following the listener rules of the ALB
+    Args:
+        path: path of the endpoint
+    Returns:
+        Number of instances of the cluster serving the path, None if no cluster does
+    """
+    for _, cluster_path, instances in CLUSTERS:
+        if path.startswith(cluster_path):
+            return instances
+    return None
+
+def parse_instance(response):
+    """
+    Get the number of the instance that answered from the response payload
+    Args:
+        response: decoded JSON response
+    Returns:
+        Instance number as a string, None if the payload has no instance identity
+    """
+    if not isinstance(response, dict):
+        return None
+    match = INSTANCE_PATTERN.search(str(response.get("message", "")))
+    return match.group(1) if match else None
+
+async def scrape_metrics(urls):
+    """
+    Read the /metrics endpoint of every backend
+    Args:
+        urls: base urls of the backends
+    Returns:
+        List of parsed metrics from server_metrics.parse_metrics, empty for the backends that did not answer
+    """
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as session:
+        async def scrape(url):
+            try:
+                async with session.get(url + "/metrics") as response:
+                    return parse_metrics(await response.text())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Could not read the metrics of {url}: {e}")
+                return []
+        return await asyncio.gather(*(scrape(url) for url in urls))
+
+def server_latency_lines(path, before, after):
+    """
+    Format the latency measured by the servers of a path between two scrapes
+    Args:
+        path: path of the endpoint
+        before: metrics of the backends before the run, from scrape_metrics
+        after: metrics of the backends after the run
+    Returns:
+        List of lines
+    """
+    lines = [f"Server-side latency of {path} (time in the application, from /metrics)"]
+    for num, (backend_before, backend_after) in enumerate(zip(before, after)):
+        buckets, count, total = subtract_latency(route_latency(backend_after, path), route_latency(backend_before, path))
+        if not count:
+            continue
+        quantiles = " ".join(
+            f"p{quantile * 100:g}={histogram_quantile(buckets, quantile) * 1000:.2f}ms" for quantile in (0.5, 0.99)
+        )
+        lines.append(f"    Instance {num + 1}: {count:.0f} requests, mean={total / count * 1000:.2f}ms {quantiles}")
+    return lines
+
+def parse_server_timing(header):
+    """
+    Get the durations of a Server-Timing header, e.g. "queue;dur=0.012, handler;dur=1.5"
+    Args:
+        header: value of the header, None if the response had none
+    Returns:
+        Dictionary name -> duration in seconds, None without header
+    """
+    if not header:
+        return None
+    timing = {}
+    for metric in header.split(","):
+        name, *params = metric.strip().split(";")
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "dur":
+                try:
+                    timing[name] = float(value) / 1000
+                except ValueError:
+                    pass
+    return timing
+
+def get_shard_results_path(path, shard, processes):
+    """
+    Get the result file of a worker, every worker process writes its own file
+    Args:
+        path: result file given on the command line
+        shard: index of the worker
+        processes: number of worker processes
+    Returns:
+        Path of the result file of the worker
+    """
+    if processes <= 1:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}.worker{shard}{extension}"
+
+async def timed_call(session, url, endpoint, scheduled_time, scheduled_timestamp, stats, sink=None, semaphore=None):
+    """
+    Call an endpoint and record its latency measured from the time the request was scheduled
+    so that time spent waiting behind a slow client or server is not hidden
+    Args:
+        session: aiohttp client session
+        url: url of the endpoint
+        endpoint: workload endpoint (method and headers)
+        scheduled_time: event loop time at which the request should have been sent
+        scheduled_timestamp: the same time as an epoch timestamp for the result file
+        stats: EndpointStats receiving the result
+        sink: ResultSink receiving the result, None to keep only the statistics
+        semaphore: limit of the requests in flight of the workload, None for no limit
+    """
+    # Echoed by the server with a Server-Timing header, to split the latency and find the request in the server logs
+    request_id = uuid.uuid4().hex
+    headers = dict(endpoint["headers"])
+    headers[REQUEST_ID_HEADER] = request_id
+    stats.in_flight += 1
+    if semaphore is None:
+        status_code, response, response_headers = await call_endpoint(session, url, endpoint["method"], headers)
+    else:
+        async with semaphore:
+            status_code, response, response_headers = await call_endpoint(session, url, endpoint["method"], headers)
+    latency = asyncio.get_running_loop().time() - scheduled_time
+    stats.in_flight -= 1
+    error = response if isinstance(response, Exception) else None
+    instance = parse_instance(response)
+    server_timing = None
+    if response_headers is not None:
+        if response_headers.get(REQUEST_ID_HEADER) != request_id:
+            stats.unechoed += 1
+        server_timing = parse_server_timing(response_headers.get("Server-Timing"))
+    stats.record(latency, status_code, error, instance, time.time(), server_timing)
+    if sink is not None:
+        sink.write(scheduled_timestamp, stats.name, status_code, latency, instance, request_id, server_timing)
+
+async def report_progress(all_stats, interval, prefix=""):
+    """
+    Print a summary line per endpoint every interval seconds until cancelled
+    Args:
+        all_stats: EndpointStats of the running benchmark
+        interval: seconds between two lines
+        prefix: text identifying the worker
+    """
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
+    previous = [0] * len(all_stats)
+    while True:
+        await asyncio.sleep(interval)
+        for index, stats in enumerate(all_stats):
+            done = stats.requests
+            p99 = stats.histogram.percentile(99)
+            p99_text = f"{p99 * 1000:.1f}ms" if p99 is not None else "-"
+            print(f"{prefix}[{loop.time() - start_time:6.1f}s] {stats.name}: {done} done, {stats.error_count} errors, "
+                  f"{(done - previous[index]) / interval:.1f} req/s, {stats.in_flight} in flight, p99 {p99_text}")
+            previous[index] = done
+
+async def run_schedule(session, base_url, workload, schedule, all_stats, start_at=None, sink=None):
+    """
+    Send the requests at their scheduled offsets without waiting for earlier responses (open loop).
+    The endpoints of the workload are called at the same time, the way production traffic arrives.
+    Args:
+        session: aiohttp client session
+        base_url: url of the load balancer
+        workload: normalized workload
+        schedule: list of (send offset, endpoint index) from build_workload_schedule
+        all_stats: EndpointStats of every endpoint of the workload
+        start_at: wall clock time (time.time()) the offsets are relative to, None to start now
+        sink: ResultSink receiving every result, None to keep only the statistics
+    """
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
+    start_timestamp = time.time()
+    if start_at is not None:
+        # Convert the shared wall clock start into this process' event loop clock
+        start_time += start_at - start_timestamp
+        start_timestamp = start_at
+    semaphore = asyncio.Semaphore(workload["concurrency"]) if workload["concurrency"] else None
+    endpoints = workload["endpoints"]
+    urls = [base_url + endpoint["path"] for endpoint in endpoints]
+    tasks = []
+    for offset, index in schedule:
+        scheduled_time = start_time + offset
+        delay = scheduled_time - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(timed_call(
+            session, urls[index], endpoints[index], scheduled_time, start_timestamp + offset,
+            all_stats[index], sink, semaphore,
+        )))
+
+    await asyncio.gather(*tasks)
+    for stats in all_stats:
+        stats.elapsed = loop.time() - start_time
+
+async def run_worker(workload, dns_name, schedule, options, start_at=None, shard=0):
+    """
+    Run a workload schedule with its own client session
+    Args:
+        workload: normalized workload
+        dns_name: DNS name of the load balancer
+        schedule: list of (send offset, endpoint index)
+        options: run options from get_run_options
+        start_at: shared wall clock start time, None to start now
+        shard: index of the worker
+    Returns:
+        List of EndpointStats (one per endpoint of the workload) and the ConnectionStats of the session
+    """
+    all_stats = [EndpointStats(endpoint["path"]) for endpoint in workload["endpoints"]]
+    connections = ConnectionStats()
+    sink = None
+    if options["results"]:
+        results_path = get_shard_results_path(options["results"], shard, options["processes"])
+        sink = ResultSink(results_path, options["results_format"], options["paths"])
+
+    prefix = f"[worker {shard}] " if options["processes"] > 1 else ""
+    progress = asyncio.create_task(report_progress(all_stats, options["summary_interval"], prefix))
+    try:
+        async with aiohttp.ClientSession(
+            connector=create_connector(options["connector"]),
+            trace_configs=[create_trace_config(connections)],
+        ) as session:
+            await run_schedule(session, f"http://{dns_name}:8000", workload, schedule, all_stats, start_at, sink)
+    finally:
+        progress.cancel()
+        if sink is not None:
+            await sink.close()
+    return all_stats, connections
+
+def worker_process(workload, dns_name, schedule, options, start_at, shard):
+    """
+    Entry point of a benchmark worker process, it runs its own event loop
+    Returns:
+        Serialized EndpointStats and ConnectionStats of the shard
+    """
+    all_stats, connections = asyncio.run(run_worker(workload, dns_name, schedule, options, start_at, shard))
+    return [stats.to_dict() for stats in all_stats], connections.to_dict()
+
+def run_benchmark(workload, dns_name, schedule, options):
+    """
+    Run a workload schedule, sharded across worker processes when there are more than one
+    so that a single event loop does not cap the request rate
+    Args:
+        workload: normalized workload
+        dns_name: DNS name of the load balancer
+        schedule: list of (send offset, endpoint index)
+        options: run options from get_run_options
+    Returns:
+        List of EndpointStats and the ConnectionStats, merged from every worker
+    """
+    processes = options["processes"]
+    if processes <= 1:
+        return asyncio.run(run_worker(workload, dns_name, schedule, options))
+
+    all_stats = [EndpointStats(endpoint["path"]) for endpoint in workload["endpoints"]]
+    connections = ConnectionStats()
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        # Every worker waits for the same start time so their shards interleave as planned
+        start_at = time.time() + WORKER_STARTUP_DELAY
+        futures = [
+            pool.submit(worker_process, workload, dns_name, schedule[shard::processes], options, start_at, shard)
+            for shard in range(processes)
+        ]
+        for future in futures:
+            shard_stats, shard_connections = future.result()
+            for stats, stats_data in zip(all_stats, shard_stats):
+                stats.merge(EndpointStats.from_dict(stats_data))
+            connections.merge(ConnectionStats.from_dict(shard_connections))
+    return all_stats, connections
+
+def get_workloads(args):
+    """
+    Get the workloads to run: the one given on the command line,
+    or by default one workload per cluster run one after the other
+    Args:
+        args: parsed command line arguments
+    Returns:
+        List of (instance type label, normalized workload)
+    """
+    if args.workload:
+        return [(None, load_workload(args.workload))]
+    return [(instance_type, load_workload(path.strip("/"))) for instance_type, path, _ in CLUSTERS]
+
+def get_run_options(args, workloads):
+    """
+    Gather the settings every worker needs to run its part of the benchmark
+    Args:
+        args: parsed command line arguments
+        workloads: workloads of the run from get_workloads
+    Returns:
+        Dictionary of run options
+    """
+    paths = []
+    for _, workload in workloads:
+        paths += [endpoint["path"] for endpoint in workload["endpoints"] if endpoint["path"] not in paths]
+    return {
+        "paths": paths,
+        "processes": args.processes,
+        "connector": get_connector_settings(args),
+        "results": args.results,
+        "results_format": args.results_format,
+        "summary_interval": args.summary_interval,
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the clusters behind the load balancer")
+    parser.add_argument("--workload", default=None,
+                        help=f"workload to run, one of {', '.join(WORKLOADS)} or a JSON file; "
+                             "by default each cluster is benchmarked alone, one after the other")
+    parser.add_argument("--requests", type=int, default=1000,
+                        help="number of requests sent at once per workload in burst mode")
+    parser.add_argument("--rps", type=float, default=None,
+                        help="target request rate per workload, switches to open-loop mode")
+    parser.add_argument("--duration", type=float, default=30.0,
+                        help="duration in seconds of an open-loop run")
+    parser.add_argument("--arrival", choices=["constant", "poisson"], default="constant",
+                        help="arrival process of an open-loop run")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="random seed of the poisson arrivals")
+    parser.add_argument("--processes", type=int, default=1,
+                        help=f"number of worker processes sharing the load (this machine has {os.cpu_count()} cores)")
+    parser.add_argument("--connector", choices=sorted(CONNECTOR_PROFILES), default="default",
+                        help="connection pool profile of the client sessions")
+    parser.add_argument("--pool-limit", type=int, default=None,
+                        help="override the maximum number of connections per session (0 for no limit)")
+    parser.add_argument("--keepalive", type=float, default=None,
+                        help="override the keep-alive timeout of idle connections in seconds")
+    parser.add_argument("--force-close", action="store_true",
+                        help="open a new connection for every request")
+    parser.add_argument("--dns-ttl", type=int, default=None,
+                        help="override the DNS cache TTL in seconds (0 disables the cache)")
+    parser.add_argument("--results", default=None,
+                        help="file receiving the result of every request (one file per worker process)")
+    parser.add_argument("--results-format", choices=["jsonl", "binary"], default="jsonl",
+                        help="format of the result file")
+    parser.add_argument("--summary-interval", type=float, default=5.0,
+                        help="seconds between two progress lines")
+    parser.add_argument("--profile", choices=["fixed", "step"], default="fixed",
+                        help="fixed: one burst or open-loop run per cluster, step: increasing request rates until saturation")
+    parser.add_argument("--start-rps", type=float, default=50.0,
+                        help="request rate of the first step")
+    parser.add_argument("--step-rps", type=float, default=50.0,
+                        help="request rate added at every step")
+    parser.add_argument("--step-duration", type=float, default=30.0,
+                        help="duration in seconds of every step")
+    parser.add_argument("--max-steps", type=int, default=20,
+                        help="maximum number of steps per cluster")
+    parser.add_argument("--p99-threshold", type=float, default=500.0,
+                        help="highest acceptable p99 latency of a step in milliseconds")
+    parser.add_argument("--max-error-rate", type=float, default=0.001,
+                        help="highest acceptable share of failed requests of a step")
+    parser.add_argument("--keep-going", action="store_true",
+                        help="run every step instead of stopping after the first one that misses the objectives")
+    parser.add_argument("--save-dir", default=RUNS_DIRECTORY,
+                        help="directory where the result of the run is saved for later comparison")
+    parser.add_argument("--no-save", action="store_true",
+                        help="do not save the result of the run")
+    parser.add_argument("--label", default=None,
+                        help="short name added to the id of the saved run")
+    parser.add_argument("--server-commit", default=None,
+                        help="commit deployed on the servers when it is not the one of this checkout")
+    parser.add_argument("--local", action="store_true",
+                        help="benchmark the FastAPI apps started on this machine behind a local proxy instead of the ALB")
+    parser.add_argument("--local-workers", type=int, default=1,
+                        help="number of worker processes of every local FastAPI server")
+    parser.add_argument("--local-request-log", choices=("off", "sampled", "all"), default=None,
+                        help="request log mode of the local FastAPI servers, to measure the cost of logging")
+    parser.add_argument("--local-response-mode", choices=("default", "fast"), default=None,
+                        help="response mode of the local FastAPI servers")
+    parser.add_argument("--server-metrics", action="store_true",
+                        help="with --local, also report the latency measured by every server from its /metrics endpoint")
+    return parser.parse_args(argv)
+
+def main(args):
+    if args.local:
+        with LocalCluster(workers=args.local_workers, request_log=args.local_request_log,
+                          response_mode=args.local_response_mode) as cluster:
+            run_all(args, cluster.host, "local", cluster.backends if args.server_metrics else None)
+        return
+
     dns_name = get_load_balancer_dns()
     if not dns_name:
         print("No DNS name available for benchmarking.")
         return
+    if args.server_metrics:
+        print("--server-metrics needs --local, the load balancer does not route /metrics")
+    run_all(args, dns_name, "alb")
+
+def get_run_metadata(args, options, workloads, target):
+    """
+    Describe a run so that saved runs can be told apart and compared
+    Args:
+        args: parsed command line arguments
+        options: run options from get_run_options
+        workloads: workloads of the run from get_workloads
+        target: "alb" or "local"
+    Returns:
+        Dictionary of metadata
+    """
+    settings = ("profile", "requests", "rps", "duration", "arrival", "seed", "start_rps", "step_rps",
+                "step_duration", "p99_threshold", "max_error_rate", "label", "server_commit", "local_workers",
+                "local_request_log", "local_response_mode")
+    metadata = {setting: getattr(args, setting) for setting in settings}
+    metadata.update({
+        "target": target,
+        "processes": options["processes"],
+        "connector_profile": args.connector,
+        "connector": options["connector"],
+        "workloads": [workload for _, workload in workloads],
+        "clusters": [
+            {"path": path, "instance_type": instance_type if target == "alb" else "local", "instances": instances}
+            for instance_type, path, instances in CLUSTERS
+        ],
+    })
+    return metadata
+
+def run_all(args, dns_name, target, backends=None):
+    """
+    Benchmark both clusters one after the other with the selected load profile and save the result
+    Args:
+        args: parsed command line arguments
+        dns_name: DNS name of the load balancer
+        target: "alb" or "local"
+        backends: dictionary cluster path -> backend urls whose /metrics are reported, None to skip them
+    """
+    if args.processes > 1:
+        print(f"Load shared across {args.processes} worker processes")
+    workloads = get_workloads(args)
+    options = get_run_options(args, workloads)
+    print(f"Connector profile {args.connector}: {options['connector']}")
+    if args.results:
+        # Results are appended by the workers, start from empty files
+        for shard in range(args.processes):
+            results_path = get_shard_results_path(args.results, shard, args.processes)
+            if os.path.exists(results_path):
+                os.remove(results_path)
+
+    if args.profile == "step":
+        endpoints, connections, steps = [], [], run_step_profile(args, dns_name, options, workloads)
+    else:
+        (endpoints, connections), steps = run_fixed_profile(args, dns_name, options, workloads, backends), None
+
+    if not args.no_save:
+        metadata = get_run_metadata(args, options, workloads, target)
+        path = save_run(args.save_dir, metadata, endpoints, connections, steps)
+        print(f"\nRun saved to {path}")
+
+def describe_workload(label, workload):
+    """
+    Format the title of a workload run
+    """
+    if label:
+        return f"{label} instances"
+    mix = ", ".join(f"{endpoint['path']} x{endpoint['weight']:g}" for endpoint in workload["endpoints"])
+    concurrency = f", at most {workload['concurrency']} in flight" if workload["concurrency"] else ""
+    return f"workload {workload['name']} ({mix}{concurrency})"
+
+def run_fixed_profile(args, dns_name, options, workloads, backends=None):
+    """
+    Run one burst or open-loop benchmark per workload and print the results
+    Args:
+        args: parsed command line arguments
+        dns_name: DNS name of the load balancer
+        options: run options from get_run_options
+        workloads: workloads of the run from get_workloads
+        backends: dictionary cluster path -> backend urls whose /metrics are reported, None to skip them
+    Returns:
+        List of EndpointStats of every endpoint and list of (paths, ConnectionStats) of every workload
+    """
+    if args.rps is None:
+        print(f"\nBurst mode: {args.requests} requests per workload")
+    else:
+        print(f"\nOpen-loop mode: {args.rps} req/s ({args.arrival}) for {args.duration} seconds per workload")
 
-    num_requests = 1000
-    start_time = time.time()
+    endpoints = []
+    connections = []
+    server_lines = []
+    for label, workload in workloads:
+        schedule = build_workload_schedule(workload, args.requests, args.rps, args.duration, args.arrival, args.seed)
 
-    print("\nRunning ec2.micro instances\n")
-    async with aiohttp . ClientSession () as session :
-        tasks = [call_endpoint_http1(session, i, dns_name) for i in range (num_requests)]
-        await asyncio.gather(*tasks)
+        print(f"\nRunning {describe_workload(label, workload)}\n")
+        scraped = {}
+        if backends:
+            scraped = {path: asyncio.run(scrape_metrics(urls)) for path, urls in backends.items()}
+        all_stats, workload_connections = run_benchmark(workload, dns_name, schedule, options)
+        endpoints += all_stats
+        connections.append(([stats.name for stats in all_stats], workload_connections))
+        for stats in all_stats:
+            for cluster_path, before in scraped.items():
+                if stats.name.startswith(cluster_path):
+                    after = asyncio.run(scrape_metrics(backends[cluster_path]))
+                    server_lines += server_latency_lines(stats.name, before, after)
 
-    end_time = time.time()
-    print(f"\nTotal time taken: {end_time - start_time:.2f} seconds")
-    print(f"Average time per request:{(end_time - start_time)/num_requests:.4f} seconds")
+    print("\nResults")
+    for stats in endpoints:
+        print("\n".join(stats.summary_lines(get_instance_count(stats.name))))
+    for paths, workload_connections in connections:
+        print(f"Client session of {', '.join(paths)}")
+        print("\n".join(workload_connections.summary_lines()))
+    if server_lines:
+        print("\n".join(server_lines))
+    return endpoints, connections
 
-    num_requests = 1000
-    start_time = time.time()
+def run_step_profile(args, dns_name, options, workloads):
+    """
+    Raise the request rate of every workload step by step and report the saturation point (knee)
+    Args:
+        args: parsed command line arguments
+        dns_name: DNS name of the load balancer
+        options: run options from get_run_options
+        workloads: workloads of the run from get_workloads
+    Returns:
+        Dictionary path -> list of (target rps of the workload, EndpointStats) of the steps
+    """
+    p99_threshold = args.p99_threshold / 1000
+    print(f"\nStep profile: from {args.start_rps} req/s, +{args.step_rps} req/s every {args.step_duration} seconds "
+          f"({args.arrival} arrivals)")
 
-    print("\nRunning ec2.large instances\n")
-    async with aiohttp.ClientSession() as session:
-        tasks = [call_endpoint_http2(session, i, dns_name) for i in range(num_requests)]
-        await asyncio.gather(*tasks)
+    all_steps = {}
+    for label, workload in workloads:
+        print(f"\nRunning {describe_workload(label, workload)}\n")
+        for endpoint in workload["endpoints"]:
+            all_steps[endpoint["path"]] = []
+        for step in range(args.max_steps):
+            rps = args.start_rps + step * args.step_rps
+            print(f"Step {step + 1}: {rps:g} req/s")
+            schedule = build_workload_schedule(workload, None, rps, args.step_duration, args.arrival, args.seed)
+            all_stats, _ = run_benchmark(workload, dns_name, schedule, options)
+            for stats in all_stats:
+                all_steps[stats.name].append((rps, stats))
+            # The workload is saturated as soon as one of its endpoints misses the objectives
+            if not args.keep_going and not all(step_passes(stats, p99_threshold, args.max_error_rate) for stats in all_stats):
+                break
 
-    end_time = time.time()
-    print(f"\nTotal time taken: {end_time - start_time:.2f} seconds")
-    print(f"Average time per request:{(end_time - start_time) / num_requests:.4f} seconds")
+    print("\nResults")
+    for path, steps in all_steps.items():
+        print("\n".join(step_profile_lines(path, steps, p99_threshold, args.max_error_rate)))
+    return all_steps
 
-#if __name__ == " __main__ ":
-asyncio.run(main ())
\ No newline at end of file
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,114 @@
+from botocore.exceptions import ClientError
+
+CLUSTER_TAG = "Cluster"
+
+class FleetInventory:
+    """
+    In-memory view of the launched instances: ID, type, cluster, IPs and state.
+    It is filled from one bulk describe at launch and only the instances marked stale or in transition
+    (neither running nor terminated) are described again, so the control loop classifies instances without calling EC2.
+    """
+
+    def __init__(self):
+        self.instances = {}
+        self.stale = set()
+        self.describe_calls = 0
+
+    @classmethod
+    def from_descriptions(cls, descriptions, clusters=None):
+        """
+        Create the inventory from describe_instances results
+        Args:
+            descriptions: dictionary instance ID -> instance description (from wait_for_instances_running)
+            clusters: dictionary instance ID -> cluster name, for instances without a Cluster tag
+        Returns:
+            FleetInventory
+        """
+        inventory = cls()
+        for instance_id, description in descriptions.items():
+            inventory.add(description, (clusters or {}).get(instance_id))
+        return inventory
+
+    def add(self, description, cluster=None):
+        """
+        Add or update an instance from its describe_instances description
+        Args:
+            description: instance description
+            cluster: cluster name, the Cluster tag of the instance wins
+        Returns:
+            True if the state or an IP of a known instance changed
+        """
+        instance_id = description['InstanceId']
+        tags = {tag['Key']: tag['Value'] for tag in description.get('Tags', [])}
+        previous = self.instances.get(instance_id)
+        record = {
+            'InstanceId': instance_id,
+            'InstanceType': description['InstanceType'],
+            'Cluster': tags.get(CLUSTER_TAG) or cluster or (previous or {}).get('Cluster'),
+            'PublicIpAddress': description.get('PublicIpAddress'),
+            'PrivateIpAddress': description.get('PrivateIpAddress'),
+            'State': description['State']['Name'],
+        }
+        self.instances[instance_id] = record
+        self.stale.discard(instance_id)
+        return previous is not None and any(
+            previous[key] != record[key] for key in ('State', 'PublicIpAddress', 'PrivateIpAddress')
+        )
+
+    def get(self, instance_id):
+        return self.instances.get(instance_id)
+
+    def running_ids(self):
+        """
+        IDs of the instances last seen running
+        """
+        return [instance_id for instance_id, record in self.instances.items() if record['State'] == 'running']
+
+    def transitional_ids(self):
+        """
+        IDs of the instances that are neither running nor terminated, e.g. pending or stopped, whose state can still change
+        """
+        return [instance_id for instance_id, record in self.instances.items() if record['State'] not in ('running', 'terminated')]
+
+    def mark_stale(self, instance_ids):
+        """
+        Ask for the state of instances to be described again at the next refresh, e.g. when they stop reporting metrics
+        Args:
+            instance_ids: IDs of the instances
+        """
+        self.stale.update(instance_id for instance_id in instance_ids if instance_id in self.instances)
+
+    def refresh(self, ec2_client, instance_ids=None):
+        """
+        Describe the stale instances (or the given ones) again in one paginated call
+        Args:
+            ec2_client: boto3 EC2 client
+            instance_ids: IDs to refresh, by default the stale instances and the ones neither running nor terminated,
+                so that an instance that was pending or stopped is seen again once it runs
+        Returns:
+            IDs of the instances whose state or IPs changed
+        """
+        if instance_ids is None:
+            instance_ids = self.stale.union(self.transitional_ids())
+        instance_ids = sorted(instance_ids)
+        if not instance_ids:
+            return []
+        changed = []
+        try:
+            for page in ec2_client.get_paginator('describe_instances').paginate(InstanceIds=instance_ids):
+                self.describe_calls += 1
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        if self.add(instance):
+                            changed.append(instance['InstanceId'])
+        except ClientError as e:
+            # Not retried at every round, the instances are marked stale again if they still report nothing
+            print(f"Error refreshing the fleet inventory: {e}")
+            self.stale.difference_update(instance_ids)
+            return changed
+        for instance_id in changed:
+            record = self.instances[instance_id]
+            print(f"Instance {instance_id} ({record['Cluster']}) is now {record['State']}, public IP {record['PublicIpAddress']}")
+        print(f"Refreshed {len(instance_ids)} instances in the fleet inventory, {len(changed)} changed "
+              f"({self.describe_calls} describe calls since launch)")
+        return changed
@@ -0,0 +1,123 @@
+import argparse
+import importlib.util
+import os
+import sys
+
+# Idle timeout of the load balancer created by start.py (the ALB default)
+ALB_IDLE_TIMEOUT = 60
+# The server must keep idle connections open longer than the ALB, otherwise the ALB can send a request
+# on a connection the server is closing and answer 502
+KEEP_ALIVE_TIMEOUT = ALB_IDLE_TIMEOUT + 5
+# Pending connections the kernel queues while the workers are busy, capped by net.core.somaxconn
+BACKLOG = 4096
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "my_fastapi.py")
+
+# Memory kept for the system and used by every worker process, to size the workers on small instances
+RESERVED_MEMORY_MB = 256
+WORKER_MEMORY_MB = 128
+
+def get_core_count():
+    """
+    Get the number of cores this process can run on
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def get_memory_mb():
+    """
+    Get the total memory of the machine
+    Returns:
+        Memory in MB, None if it cannot be read
+    """
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def get_somaxconn():
+    """
+    Get the kernel limit of the listen backlog
+    Returns:
+        Limit, None if it cannot be read
+    """
+    try:
+        with open("/proc/sys/net/core/somaxconn") as file:
+            return int(file.read())
+    except (OSError, ValueError):
+        return None
+
+def choose_workers(cores, memory_mb):
+    """
+    Choose the number of worker processes: one per core, as long as the memory holds them
+    Args:
+        cores: number of cores
+        memory_mb: total memory in MB, None if unknown
+    Returns:
+        Number of workers
+    """
+    workers = cores
+    if memory_mb is not None:
+        workers = min(workers, (memory_mb - RESERVED_MEMORY_MB) // WORKER_MEMORY_MB)
+    return max(1, workers)
+
+def get_available(module, fallback):
+    """
+    Get the name of an optional module if it is installed
+    Args:
+        module: name of the module
+        fallback: name returned when it is not installed
+    """
+    return module if importlib.util.find_spec(module) is not None else fallback
+
+def get_launch_settings(workers=None):
+    """
+    Choose the uvicorn settings for this machine
+    Args:
+        workers: number of worker processes, None to choose it
+    Returns:
+        Dictionary of settings
+    """
+    cores = get_core_count()
+    memory_mb = get_memory_mb()
+    return {
+        "cores": cores,
+        "memory_mb": memory_mb,
+        "workers": workers or choose_workers(cores, memory_mb),
+        "loop": get_available("uvloop", "asyncio"),
+        "http": get_available("httptools", "h11"),
+        "backlog": BACKLOG,
+        "somaxconn": get_somaxconn(),
+        "timeout_keep_alive": KEEP_ALIVE_TIMEOUT,
+    }
+
+def print_settings(settings, server_args):
+    """
+    Print the effective configuration of the server
+    Args:
+        settings: settings from get_launch_settings
+        server_args: other arguments given to my_fastapi.py
+    """
+    print(f"Machine: {settings['cores']} cores, {settings['memory_mb']} MB of memory")
+    print(f"Server: {settings['workers']} workers, event loop {settings['loop']}, HTTP parser {settings['http']}")
+    print(f"Connections: backlog {settings['backlog']}, keep-alive timeout {settings['timeout_keep_alive']} s "
+          f"(ALB idle timeout {ALB_IDLE_TIMEOUT} s)")
+    if settings["somaxconn"] is not None and settings["somaxconn"] < settings["backlog"]:
+        print(f"Warning: net.core.somaxconn is {settings['somaxconn']}, the kernel limits the backlog to it")
+    print(f"Other arguments: {' '.join(server_args) or 'none'}", flush=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run my_fastapi.py with settings chosen for this machine, other arguments are passed to it"
+    )
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes, one per core by default")
+    args, server_args = parser.parse_known_args()
+    settings = get_launch_settings(args.workers)
+    print_settings(settings, server_args)
+    # A new interpreter, so that the workers read the options from the environment before the app is created
+    os.execv(sys.executable, [
+        sys.executable, SERVER_SCRIPT, *server_args,
+        "--workers", str(settings["workers"]), "--loop", settings["loop"], "--http", settings["http"],
+        "--backlog", str(settings["backlog"]), "--timeout-keep-alive", str(settings["timeout_keep_alive"]),
+    ])
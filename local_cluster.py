@@ -0,0 +1,234 @@
+import argparse
+import asyncio
+import itertools
+import os
+import subprocess
+import sys
+import time
+import aiohttp
+from aiohttp import web
+
+# Same layout as start.py: five t2.micro instances serve /cluster1 and four t2.large instances /cluster2
+CLUSTER1_INSTANCES = 5
+CLUSTER2_INSTANCES = 4
+CLUSTER1_BASE_PORT = 8100
+CLUSTER2_BASE_PORT = 8200
+PROXY_PORT = 8000
+
+# Headers that only concern a single connection and must not be forwarded
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade", "host", "content-length",
+}
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+def start_backends(count, base_port, host="127.0.0.1", workers=1, request_log=None, response_mode=None):
+    """
+    Start one my_fastapi server per instance, numbered from 1 like the instances of a cluster
+    Args:
+        count: number of instances
+        base_port: port of the first backend, the next ones follow
+        host: interface the backends listen on
+        workers: number of worker processes of every backend
+        request_log: request log mode of the backends, their default when None
+        response_mode: response mode of the backends, their default when None
+    Returns:
+        List of (process, url) of the backends
+    """
+    backends = []
+    for num in range(count):
+        port = base_port + num
+        command = [sys.executable, "my_fastapi.py", "--host", host, "--port", str(port), "--workers", str(workers),
+                   "--instance-number", str(num + 1), "--log-level", "warning"]
+        if request_log is not None:
+            command += ["--request-log", request_log]
+        if response_mode is not None:
+            command += ["--response-mode", response_mode]
+        process = subprocess.Popen(command, cwd=REPOSITORY_DIRECTORY)
+        backends.append((process, f"http://{host}:{port}"))
+    return backends
+
+def stop_processes(processes, timeout=5):
+    """
+    Stop processes, killing them if they do not exit in time
+    Args:
+        processes: list of subprocess.Popen
+        timeout: seconds to wait for a clean exit
+    """
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+async def wait_until_answering(urls, timeout=30):
+    """
+    Wait until every url answers an HTTP request
+    Args:
+        urls: urls to poll
+        timeout: seconds before giving up
+    Returns:
+        True if every url answered in time
+    """
+    deadline = time.monotonic() + timeout
+    pending = list(urls)
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=2)) as session:
+        while pending and time.monotonic() < deadline:
+            for url in list(pending):
+                try:
+                    async with session.get(url) as response:
+                        await response.read()
+                    pending.remove(url)
+                except aiohttp.ClientError:
+                    pass
+            if pending:
+                await asyncio.sleep(0.2)
+    return not pending
+
+def create_proxy_app(routes):
+    """
+    Create a reverse proxy reproducing the listener rules of create_listener_rules in start.py:
+    paths matching a prefix are forwarded round-robin to the backends of that cluster
+    and anything else gets the fixed 404 response of the listener default action
+    Args:
+        routes: list of (path prefix, backend urls), evaluated in order like rule priorities
+    Returns:
+        aiohttp web application
+    """
+    cycles = [(prefix, itertools.cycle(urls)) for prefix, urls in routes]
+
+    async def forward(request):
+        for prefix, backends in cycles:
+            if request.path.startswith(prefix):
+                break
+        else:
+            return web.Response(status=404, text="404 Not Found", content_type="text/plain")
+
+        headers = {name: value for name, value in request.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+        body = await request.read()
+        session = request.app["session"]
+        try:
+            async with session.request(request.method, next(backends) + request.path_qs, headers=headers, data=body) as response:
+                payload = await response.read()
+                response_headers = {
+                    name: value for name, value in response.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS
+                }
+                return web.Response(status=response.status, body=payload, headers=response_headers)
+        except aiohttp.ClientError:
+            return web.Response(status=502, text="502 Bad Gateway", content_type="text/plain")
+
+    async def open_session(app):
+        app["session"] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+        yield
+        await app["session"].close()
+
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", forward)
+    app.cleanup_ctx.append(open_session)
+    return app
+
+def start_proxy(routes, port=PROXY_PORT, host="127.0.0.1"):
+    """
+    Start the reverse proxy in its own process so that it does not share a core with the benchmark
+    Args:
+        routes: list of (path prefix, backend urls)
+        port: port of the proxy
+        host: interface the proxy listens on
+    Returns:
+        Proxy process
+    """
+    route_args = [f"{prefix}={','.join(urls)}" for prefix, urls in routes]
+    return subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "proxy", "--host", host, "--port", str(port)] + route_args,
+    )
+
+class LocalCluster:
+    """
+    The FastAPI apps behind a local path-routing proxy, a stand-in for the ALB and its two target groups
+    """
+
+    def __init__(self, host="127.0.0.1", port=PROXY_PORT, workers=1, request_log=None, response_mode=None):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.request_log = request_log
+        self.response_mode = response_mode
+        self.processes = []
+        self.backends = {}
+
+    def start(self, timeout=30):
+        """
+        Start the backends and the proxy and wait until they answer
+        Args:
+            timeout: seconds before giving up
+        """
+        cluster1 = start_backends(CLUSTER1_INSTANCES, CLUSTER1_BASE_PORT, self.host, self.workers,
+                                  self.request_log, self.response_mode)
+        cluster2 = start_backends(CLUSTER2_INSTANCES, CLUSTER2_BASE_PORT, self.host, self.workers,
+                                  self.request_log, self.response_mode)
+        self.processes = [process for process, _ in cluster1 + cluster2]
+        routes = [
+            ("/cluster1", [url for _, url in cluster1]),
+            ("/cluster2", [url for _, url in cluster2]),
+        ]
+        self.processes.append(start_proxy(routes, self.port, self.host))
+        self.backends = dict(routes)
+
+        urls = [url + "/health" for _, url in cluster1 + cluster2]
+        urls += [f"http://{self.host}:{self.port}{prefix}" for prefix, _ in routes]
+        if not asyncio.run(wait_until_answering(urls, timeout)):
+            self.stop()
+            raise RuntimeError("The local cluster did not start in time")
+        print(f"Local cluster answering on http://{self.host}:{self.port} "
+              f"({len(cluster1)} backends on /cluster1, {len(cluster2)} backends on /cluster2)")
+
+    def stop(self):
+        """
+        Stop the proxy and the backends
+        """
+        stop_processes(self.processes)
+        self.processes = []
+        self.backends = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the FastAPI clusters locally behind a path-routing proxy")
+    subparsers = parser.add_subparsers(dest="command")
+    proxy_parser = subparsers.add_parser("proxy", help="run only the reverse proxy")
+    proxy_parser.add_argument("--host", default="127.0.0.1")
+    proxy_parser.add_argument("--port", type=int, default=PROXY_PORT)
+    proxy_parser.add_argument("routes", nargs="+", help="routes as PREFIX=URL,URL,...")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=PROXY_PORT)
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes of every backend")
+    parser.add_argument("--request-log", choices=("off", "sampled", "all"), default=None,
+                        help="request log mode of the backends")
+    parser.add_argument("--response-mode", choices=("default", "fast"), default=None,
+                        help="response mode of the backends")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "proxy":
+        routes = []
+        for route in args.routes:
+            prefix, urls = route.split("=", 1)
+            routes.append((prefix, urls.split(",")))
+        web.run_app(create_proxy_app(routes), host=args.host, port=args.port, print=None, access_log=None)
+    else:
+        with LocalCluster(args.host, args.port, args.workers, args.request_log, args.response_mode):
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                print("Stopping the local cluster")
@@ -1,9 +1,12 @@
 #!/bin/bash
+# check_error sees the status of the python scripts, not of tee
+set -o pipefail
 
 # Define paths to your Python files
 START_SCRIPT="start.py"
 TERMINATE_SCRIPT="terminate.py"
 BENCHMARK_SCRIPT="benchmarkscript.py"
+READINESS_SCRIPT="readiness.py"
 
 # Log file to capture the output
 LOG_FILE="cloud_automation.log"
@@ -17,14 +20,16 @@ check_error() {
 }
 
 echo "Starting cloud infrastructure with $START_SCRIPT..." | tee -a $LOG_FILE
+# Remove the DNS name of a previous run, the readiness check waits for start.py to write the new one
+rm -f load_balancer_dns.txt
 # Run the start.py script to set up infrastructure
 python3 -u $START_SCRIPT | tee -a $LOG_FILE &
 check_error "starting cloud infrastructure"
 
-sleep 60
-# Sleep to allow instances to start (adjust sleep time based on instance setup time)
+# Wait until the load balancer answers on /cluster1 and /cluster2 (instead of a fixed delay)
 echo "Waiting for instances to fully start..." | tee -a $LOG_FILE
-sleep 240  
+python3 -u $READINESS_SCRIPT --timeout 900 | tee -a $LOG_FILE
+check_error "waiting for the load balancer"
 
 echo "Running benchmarks with $BENCHMARK_SCRIPT..." | tee -a $LOG_FILE
 # Run the benchmark script
@@ -1,41 +1,268 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Query
+from fastapi.responses import Response
 import uvicorn
-import logging
+import argparse
+import asyncio
+import json
+import os
+from request_logging import (
+    REQUEST_LOG_ENV, REQUEST_LOG_MODES, REQUEST_LOG_SAMPLE_ENV, REQUEST_LOG_SLOW_ENV, RequestLog, RequestLogMiddleware,
+)
+from server_admission import (
+    MAX_CONCURRENCY_ENV, MAX_QUEUE_ENV, QUEUE_TIMEOUT_ENV, AdmissionControl, AdmissionMiddleware,
+)
+from server_health import HealthMiddleware, LoopLagMonitor
+from server_metrics import CONTENT_TYPE, SERVER_METRICS_ENV, MetricsMiddleware, ServerMetrics
+from server_timing import TimingMiddleware
+from server_work import (
+    MAX_CPU_MS, MAX_MEMORY_MB, MAX_SLEEP_MS, WORK_EXECUTOR_ENV, WORK_EXECUTORS, WORK_POOL_SIZE_ENV, WorkPool,
+    allocate_memory, burn_cpu,
+)
+from shared_counter import SHARED_COUNTER_ENV, SharedCounter
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+try:
+    import orjson
+    encode_json = orjson.dumps
+except ImportError:
+    def encode_json(content):
+        return json.dumps(content, separators=(",", ":")).encode()
 
-# Create FastAPI app
-app = FastAPI()
+# default: FastAPI encodes the returned dict, fast: pre-encoded responses where only the request number is filled in
+RESPONSE_MODE_ENV = "RESPONSE_MODE"
+RESPONSE_MODES = ("default", "fast")
+RESPONSE_MODE = os.environ.get(RESPONSE_MODE_ENV, "default")
+NUMBER_PLACEHOLDER = "{request_number}"
 
-# Unique instance ID (replace X with the actual instance number)
-INSTANCE_ID = "Instance number X"
+# Synthetic work routes of every cluster, /clusterN/work/KIND
+WORK_KINDS = ("cpu", "memory", "sleep")
 
-counter = {
-    "cluster1": 0,
-    "cluster2": 0,
-}
+# Routes with their own request metrics
+METRIC_ROUTES = ["/", "/cluster1", "/cluster2", "/metrics"] + [
+    f"/cluster{cluster_number}/work/{kind}" for cluster_number in (1, 2) for kind in WORK_KINDS
+]
+
+# Request logging, written by a background thread and sampled (see request_logging.py)
+request_log = RequestLog.from_environment("my_fastapi")
+
+# Pool running the CPU work of the work routes
+work_pool = WorkPool.from_environment()
+
+# Event loop lag of the worker, part of the readiness of /ready
+lag_monitor = LoopLagMonitor()
+
+@asynccontextmanager
+async def lifespan(app):
+    lag_monitor.start()
+    yield
+    await lag_monitor.stop()
+    work_pool.shutdown()
+
+# Request metrics, added up over every worker process when the server runs more than one
+metrics = ServerMetrics(METRIC_ROUTES, os.environ.get(SERVER_METRICS_ENV))
+
+# Concurrency limit of every worker, rejected requests get a 503 at once (off unless configured)
+admission = AdmissionControl.from_environment(metrics)
+
+# Create FastAPI app, the middleware added last runs first
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestLogMiddleware, request_log=request_log)
+app.add_middleware(AdmissionMiddleware, admission=admission, metrics=metrics)
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+
+# X-Request-ID echo and Server-Timing header (queue and handler time)
+app.add_middleware(TimingMiddleware)
+
+# Health checks, answered first so that they skip the framework, the request log and the metrics
+app.add_middleware(HealthMiddleware, metrics=metrics, lag_monitor=lag_monitor)
+
+# Unique instance ID, the instance number is given by start.py through the environment
+INSTANCE_ID = f"Instance number {os.environ.get('INSTANCE_NUMBER', 'X')}"
+
+# Request counters, shared by every worker process when the server runs more than one
+counter = SharedCounter(["cluster1", "cluster2"], os.environ.get(SHARED_COUNTER_ENV))
 
 @app.get("/")
 async def root():
     return {"message": "Welcome to the FastAPI application!"}
 
-@app.get("/cluster1")
+@app.get("/metrics", response_class=Response)
+async def get_metrics():
+    return Response(metrics.export(), media_type=CONTENT_TYPE)
+
 async def cluster1_root():
-    global counter  
-    counter["cluster1"] += 1  
-    message = f"{INSTANCE_ID} (Cluster 1) has received request number {counter['cluster1']}"
-    logger.info(message)
+    message = f"{INSTANCE_ID} (Cluster 1) has received request number {counter.increment('cluster1')}"
+    request_log.info(message)
     return {"message": message}
 
-@app.get("/cluster2")
 async def cluster2_root():
-    global counter  
-    counter["cluster2"] += 1  
-    message = f"{INSTANCE_ID} (Cluster 2) has received request number {counter['cluster2']}"
-    logger.info(message)
+    message = f"{INSTANCE_ID} (Cluster 2) has received request number {counter.increment('cluster2')}"
+    request_log.info(message)
     return {"message": message}
 
+def build_response_template(cluster_number):
+    """
+    Encode the response of a cluster once, around the place of the request number
+    Args:
+        cluster_number: number of the cluster
+    Returns:
+        (bytes before the request number, bytes after it)
+    """
+    message = f"{INSTANCE_ID} (Cluster {cluster_number}) has received request number {NUMBER_PLACEHOLDER}"
+    prefix, suffix = encode_json({"message": message}).split(NUMBER_PLACEHOLDER.encode())
+    return prefix, suffix
+
+def create_fast_handler(name, cluster_number):
+    """
+    Create a cluster handler returning pre-encoded bytes. Returning a Response skips
+    the response model validation and JSON encoding of FastAPI
+    Args:
+        name: name of the request counter
+        cluster_number: number of the cluster
+    Returns:
+        Handler coroutine function
+    """
+    prefix, suffix = build_response_template(cluster_number)
+
+    async def cluster_root():
+        number = counter.increment(name)
+        # The message is only formatted if the request is logged, by the logging thread
+        request_log.info("%s (Cluster %d) has received request number %d", INSTANCE_ID, cluster_number, number)
+        return Response(prefix + b"%d" % number + suffix, media_type="application/json")
+    return cluster_root
+
+if RESPONSE_MODE == "fast":
+    app.add_api_route("/cluster1", create_fast_handler("cluster1", 1), methods=["GET"], response_class=Response)
+    app.add_api_route("/cluster2", create_fast_handler("cluster2", 2), methods=["GET"], response_class=Response)
+else:
+    app.add_api_route("/cluster1", cluster1_root, methods=["GET"])
+    app.add_api_route("/cluster2", cluster2_root, methods=["GET"])
+
+def add_work_routes(cluster_number):
+    """
+    Add the synthetic work routes of a cluster, to give the requests a real cost
+    Args:
+        cluster_number: number of the cluster
+    """
+    prefix = f"/cluster{cluster_number}/work"
+    identity = f"{INSTANCE_ID} (Cluster {cluster_number})"
+
+    async def cpu_work(ms: int = Query(10, ge=0, le=MAX_CPU_MS)):
+        iterations = await work_pool.run(burn_cpu, ms)
+        return {"message": f"{identity} used {ms} ms of CPU", "iterations": iterations}
+
+    async def memory_work(mb: int = Query(10, ge=0, le=MAX_MEMORY_MB), hold_ms: int = Query(0, ge=0, le=MAX_SLEEP_MS)):
+        # The memory stays in this worker for the whole request, only the page writes leave the event loop
+        buffer = await asyncio.to_thread(allocate_memory, mb)
+        await asyncio.sleep(hold_ms / 1000)
+        size = len(buffer)
+        del buffer
+        return {"message": f"{identity} held {mb} MB for {hold_ms} ms", "bytes": size}
+
+    async def sleep_work(ms: int = Query(10, ge=0, le=MAX_SLEEP_MS)):
+        # Waiting on the event loop like a call to a database or another service would
+        await asyncio.sleep(ms / 1000)
+        return {"message": f"{identity} waited {ms} ms"}
+
+    for kind, handler in zip(WORK_KINDS, (cpu_work, memory_work, sleep_work)):
+        app.add_api_route(f"{prefix}/{kind}", handler, methods=["GET"])
+
+add_work_routes(1)
+add_work_routes(2)
+
+def run_server(host="0.0.0.0", port=8000, workers=1, instance_number=None, server_options=None,
+               response_mode=None, **uvicorn_options):
+    """
+    Run the application, with a request counter and metrics shared by the workers when there are more than one
+    Args:
+        host: interface to listen on
+        port: port to listen on
+        workers: number of worker processes
+        instance_number: number of the instance, the INSTANCE_NUMBER environment variable otherwise
+        server_options: dictionary of environment variables read by the workers (REQUEST_LOG..., WORK_...)
+        response_mode: one of RESPONSE_MODES, the RESPONSE_MODE environment variable otherwise
+        uvicorn_options: other uvicorn settings
+    """
+    if instance_number is not None:
+        os.environ["INSTANCE_NUMBER"] = str(instance_number)
+    if response_mode is not None:
+        os.environ[RESPONSE_MODE_ENV] = response_mode
+    for name, value in (server_options or {}).items():
+        if value is not None:
+            os.environ[name] = str(value)
+    # The request log replaces the uvicorn access log, which writes every request from the event loop
+    uvicorn_options.setdefault("access_log", False)
+    if workers <= 1:
+        uvicorn.run("my_fastapi:app", host=host, port=port, **uvicorn_options)
+        return
+
+    # The workers import this module again and find the counter and metrics files through the environment
+    counter_path = SharedCounter.create(["cluster1", "cluster2"], prefix=f"my_fastapi-{port}")
+    os.environ[SHARED_COUNTER_ENV] = counter_path
+    # Spare metrics slots for the workers uvicorn restarts while the old one is still exiting
+    metrics_path = ServerMetrics.create(METRIC_ROUTES, slots=2 * workers, prefix=f"my_fastapi-metrics-{port}")
+    os.environ[SERVER_METRICS_ENV] = metrics_path
+    try:
+        uvicorn.run("my_fastapi:app", host=host, port=port, workers=workers, **uvicorn_options)
+    finally:
+        os.remove(counter_path)
+        os.remove(metrics_path)
+
+def create_parser(description="Run the FastAPI application"):
+    """
+    Create the command line parser of the server
+    Args:
+        description: description of the command
+    Returns:
+        argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--instance-number", default=None, help="number of the instance in its cluster")
+    parser.add_argument("--log-level", default="info")
+    parser.add_argument("--request-log", choices=REQUEST_LOG_MODES, default=None,
+                        help="log no request, a sample of the requests plus errors and slow ones, or every request")
+    parser.add_argument("--log-sample", type=int, default=None, help="in sampled mode, log 1 request in N")
+    parser.add_argument("--log-slow-ms", type=float, default=None, help="always log requests slower than this")
+    parser.add_argument("--access-log", action="store_true", help="also write the uvicorn access log")
+    parser.add_argument("--response-mode", choices=RESPONSE_MODES, default=None,
+                        help="fast returns pre-encoded responses instead of going through FastAPI encoding")
+    parser.add_argument("--work-executor", choices=WORK_EXECUTORS, default=None,
+                        help="where the CPU work of /clusterN/work/cpu runs (thread pool by default)")
+    parser.add_argument("--work-pool-size", type=int, default=None, help="threads or processes of the work pool")
+    parser.add_argument("--max-concurrency", type=int, default=None,
+                        help="requests handled at the same time by a worker, 503 beyond the queue (no limit by default)")
+    parser.add_argument("--max-queue", type=int, default=None, help="requests of a worker waiting for a slot")
+    parser.add_argument("--queue-timeout-ms", type=float, default=None, help="longest wait for a slot before a 503")
+    parser.add_argument("--loop", default="auto", help="event loop of uvicorn: auto, asyncio or uvloop")
+    parser.add_argument("--http", default="auto", help="HTTP parser of uvicorn: auto, h11 or httptools")
+    parser.add_argument("--backlog", type=int, default=2048, help="pending connections queued by the kernel")
+    parser.add_argument("--timeout-keep-alive", type=int, default=5, help="seconds an idle connection is kept open")
+    return parser
+
+def get_server_options(args):
+    """
+    Get the environment variables of the workers from the command line arguments
+    Args:
+        args: parsed command line arguments
+    Returns:
+        Dictionary of environment variables, None when not set
+    """
+    return {
+        REQUEST_LOG_ENV: args.request_log,
+        REQUEST_LOG_SAMPLE_ENV: args.log_sample,
+        REQUEST_LOG_SLOW_ENV: args.log_slow_ms,
+        WORK_EXECUTOR_ENV: args.work_executor,
+        WORK_POOL_SIZE_ENV: args.work_pool_size,
+        MAX_CONCURRENCY_ENV: args.max_concurrency,
+        MAX_QUEUE_ENV: args.max_queue,
+        QUEUE_TIMEOUT_ENV: args.queue_timeout_ms,
+    }
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    args = create_parser().parse_args()
+    run_server(args.host, args.port, args.workers, args.instance_number, get_server_options(args), args.response_mode,
+               log_level=args.log_level, access_log=args.access_log, loop=args.loop, http=args.http,
+               backlog=args.backlog, timeout_keep_alive=args.timeout_keep_alive)
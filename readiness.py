@@ -0,0 +1,226 @@
+import argparse
+import os
+import socket
+import sys
+import time
+import urllib.error
+import urllib.request
+
+# Port of the FastAPI server on the instances and of the load balancer listener
+APP_PORT = 8000
+SSH_PORT = 22
+HEALTH_PATH = "/health"
+CLUSTER_PATHS = ["/cluster1", "/cluster2"]
+
+DEFAULT_TIMEOUT = 600
+DEFAULT_INTERVAL = 5
+REQUEST_TIMEOUT = 5
+
+def wait_for(name, check, timeout=DEFAULT_TIMEOUT, interval=DEFAULT_INTERVAL):
+    """
+    Gate: call a check until it passes, and move on as soon as it does
+    Args:
+        name: name of the gate in the logs
+        check: function returning (ready, detail), an exception counts as not ready
+        timeout: seconds before giving up
+        interval: seconds between two checks
+    Returns:
+        Seconds spent waiting
+    """
+    start = time.monotonic()
+    last_detail = None
+    checks = 0
+    while True:
+        checks += 1
+        try:
+            ready, detail = check()
+        except Exception as e:
+            ready, detail = False, f"{type(e).__name__}: {e}"
+        elapsed = time.monotonic() - start
+        if ready:
+            print(f"[gate] {name}: ready after {elapsed:.1f}s ({checks} checks) {detail}", flush=True)
+            return elapsed
+        # Only print when the state changes, the gates can poll for minutes
+        if detail != last_detail:
+            print(f"[gate] {name}: waiting after {elapsed:.1f}s, {detail}", flush=True)
+            last_detail = detail
+        if elapsed + interval > timeout:
+            raise TimeoutError(f"{name} not ready after {timeout}s: {detail}")
+        time.sleep(interval)
+
+def http_status(url):
+    """
+    Get the status code of a GET request
+    Args:
+        url: URL to request
+    Returns:
+        Status code
+    """
+    try:
+        with urllib.request.urlopen(url, timeout=REQUEST_TIMEOUT) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+def port_open_check(hosts, port):
+    """
+    Check that every host accepts TCP connections on a port
+    Args:
+        hosts: IPs or names of the hosts
+        port: TCP port
+    Returns:
+        Check function for wait_for
+    """
+    def check():
+        closed = []
+        for host in hosts:
+            try:
+                socket.create_connection((host, port), timeout=REQUEST_TIMEOUT).close()
+            except OSError:
+                closed.append(host)
+        return not closed, f"{len(hosts) - len(closed)}/{len(hosts)} hosts open on port {port}"
+    return check
+
+def app_answering_check(hosts, port=APP_PORT, path=HEALTH_PATH):
+    """
+    Check that the FastAPI server of every host answers 200
+    Args:
+        hosts: IPs of the instances
+        port: port of the server
+        path: path requested
+    Returns:
+        Check function for wait_for
+    """
+    def check():
+        answering = 0
+        for host in hosts:
+            try:
+                if http_status(f"http://{host}:{port}{path}") == 200:
+                    answering += 1
+            except OSError:
+                pass
+        return answering == len(hosts), f"{answering}/{len(hosts)} servers answering {path}"
+    return check
+
+def targets_healthy_check(elbv2_client, target_group_arns):
+    """
+    Check that every target registered in the target groups is healthy
+    Args:
+        elbv2_client: boto3 elbv2 client
+        target_group_arns: ARNs of the target groups
+    Returns:
+        Check function for wait_for
+    """
+    def check():
+        states = []
+        for target_group_arn in target_group_arns:
+            response = elbv2_client.describe_target_health(TargetGroupArn=target_group_arn)
+            states += [target['TargetHealth']['State'] for target in response['TargetHealthDescriptions']]
+        healthy = states.count('healthy')
+        return bool(states) and healthy == len(states), f"{healthy}/{len(states)} targets healthy"
+    return check
+
+def listener_rules_check(elbv2_client, load_balancer_arn, port=APP_PORT, paths=CLUSTER_PATHS):
+    """
+    Check that the listener of the load balancer exists and has a forward rule for every path
+    Args:
+        elbv2_client: boto3 elbv2 client
+        load_balancer_arn: ARN of the load balancer
+        port: port of the listener
+        paths: paths that need a rule
+    Returns:
+        Check function for wait_for
+    """
+    def check():
+        listeners = elbv2_client.describe_listeners(LoadBalancerArn=load_balancer_arn)['Listeners']
+        listener_arns = [listener['ListenerArn'] for listener in listeners if listener['Port'] == port]
+        if not listener_arns:
+            return False, f"no listener on port {port}"
+        patterns = []
+        for rule in elbv2_client.describe_rules(ListenerArn=listener_arns[0])['Rules']:
+            if any(action['Type'] == 'forward' for action in rule['Actions']):
+                for condition in rule['Conditions']:
+                    if condition['Field'] == 'path-pattern':
+                        patterns += condition.get('Values', [])
+        missing = [path for path in paths if not any(pattern.startswith(path) for pattern in patterns)]
+        return not missing, f"rules missing for {missing}" if missing else f"rules for {paths}"
+    return check
+
+def load_balancer_active_check(elbv2_client, load_balancer_arn):
+    """
+    Check that the load balancer is provisioned
+    Args:
+        elbv2_client: boto3 elbv2 client
+        load_balancer_arn: ARN of the load balancer
+    Returns:
+        Check function for wait_for
+    """
+    def check():
+        response = elbv2_client.describe_load_balancers(LoadBalancerArns=[load_balancer_arn])
+        state = response['LoadBalancers'][0]['State']['Code']
+        return state == 'active', f"state {state}"
+    return check
+
+def load_balancer_answering_check(dns_name, port=APP_PORT, paths=CLUSTER_PATHS):
+    """
+    Check that the DNS name of the load balancer resolves and that every path answers 200 through it
+    Args:
+        dns_name: DNS name of the load balancer
+        port: port of the listener
+        paths: paths requested
+    Returns:
+        Check function for wait_for
+    """
+    def check():
+        try:
+            socket.getaddrinfo(dns_name, port)
+        except socket.gaierror:
+            return False, f"{dns_name} does not resolve yet"
+        statuses = {}
+        for path in paths:
+            try:
+                statuses[path] = http_status(f"http://{dns_name}:{port}{path}")
+            except OSError as e:
+                statuses[path] = type(e).__name__
+        return all(status == 200 for status in statuses.values()), f"statuses {statuses}"
+    return check
+
+def dns_file_check(path):
+    """
+    Check that the file where start.py writes the DNS name of the load balancer exists
+    Args:
+        path: path of the file
+    Returns:
+        Check function for wait_for
+    """
+    def check():
+        if not os.path.exists(path):
+            return False, f"{path} not written yet"
+        with open(path) as file:
+            dns_name = file.read().strip()
+        return bool(dns_name), dns_name or f"{path} is empty"
+    return check
+
+def read_dns_name(path):
+    with open(path) as file:
+        return file.read().strip()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Wait until the load balancer created by start.py answers on every cluster path"
+    )
+    parser.add_argument("--dns-file", default="load_balancer_dns.txt", help="file where start.py writes the DNS name")
+    parser.add_argument("--timeout", type=float, default=900, help="seconds before giving up")
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL, help="seconds between two checks")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    try:
+        wait_for("load balancer created", dns_file_check(args.dns_file), args.timeout, args.interval)
+        remaining = args.timeout - (time.monotonic() - start)
+        wait_for("load balancer answering", load_balancer_answering_check(read_dns_name(args.dns_file)),
+                 remaining, args.interval)
+    except TimeoutError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    print(f"Everything ready after {time.monotonic() - start:.1f}s")
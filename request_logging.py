@@ -0,0 +1,150 @@
+import atexit
+import itertools
+import logging
+import os
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+# Request logging settings, read from the environment so that every uvicorn worker gets them
+REQUEST_LOG_ENV = "REQUEST_LOG"
+REQUEST_LOG_SAMPLE_ENV = "REQUEST_LOG_SAMPLE"
+REQUEST_LOG_SLOW_ENV = "REQUEST_LOG_SLOW_MS"
+
+# off: nothing, sampled: 1 request in N plus errors and slow requests, all: every request
+REQUEST_LOG_MODES = ("off", "sampled", "all")
+DEFAULT_MODE = "sampled"
+DEFAULT_SAMPLE = 100
+DEFAULT_SLOW_MS = 500
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s[%(process)d]: %(message)s"
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Queue handler that leaves the formatting of the record to the listener thread,
+    the default one formats the message before queuing it, on the event loop
+    """
+
+    def prepare(self, record):
+        return record
+
+class RequestLog:
+    """
+    Request logger of a server process. The handlers only put the records in a queue,
+    a background thread formats them and writes them to stderr.
+    """
+
+    def __init__(self, name, mode=DEFAULT_MODE, sample_every=DEFAULT_SAMPLE, slow_ms=DEFAULT_SLOW_MS):
+        """
+        Args:
+            name: name of the logger
+            mode: one of REQUEST_LOG_MODES
+            sample_every: in sampled mode, log 1 request in sample_every
+            slow_ms: in sampled and all modes, requests slower than this are always logged
+        """
+        if mode not in REQUEST_LOG_MODES:
+            raise ValueError(f"Unknown request log mode {mode}, use one of {', '.join(REQUEST_LOG_MODES)}")
+        self.mode = mode
+        self.sample_every = max(1, sample_every)
+        self.slow_seconds = slow_ms / 1000
+        self.calls = itertools.count()
+        self.logger = logging.getLogger(name)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.listener = None
+        # Only the last request log of a logger writes, uvicorn imports the module of the app a second time
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+
+        if mode != "off":
+            records = queue.SimpleQueue()
+            stream_handler = logging.StreamHandler()
+            stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+            self.logger.addHandler(DeferredQueueHandler(records))
+            self.listener = QueueListener(records, stream_handler)
+            self.listener.start()
+            atexit.register(self.stop)
+
+    @classmethod
+    def from_environment(cls, name):
+        """
+        Create the request logger with the settings of the environment
+        Args:
+            name: name of the logger
+        Returns:
+            RequestLog
+        """
+        return cls(
+            name,
+            mode=os.environ.get(REQUEST_LOG_ENV, DEFAULT_MODE),
+            sample_every=int(os.environ.get(REQUEST_LOG_SAMPLE_ENV, DEFAULT_SAMPLE)),
+            slow_ms=float(os.environ.get(REQUEST_LOG_SLOW_ENV, DEFAULT_SLOW_MS)),
+        )
+
+    @property
+    def enabled(self):
+        return self.mode != "off"
+
+    def info(self, message, *args):
+        """
+        Log a request message if the request is part of the sample
+        Args:
+            message: message, formatted with args by the background thread
+            args: arguments of the message
+        """
+        if self.mode == "all" or (self.mode == "sampled" and next(self.calls) % self.sample_every == 0):
+            self.logger.info(message, *args)
+
+    def request_done(self, method, path, status_code, duration, request_id=None):
+        """
+        Log a finished request when it failed or was slow, whatever the sample
+        Args:
+            method: HTTP method
+            path: request path
+            status_code: response status code
+            duration: time spent in the application in seconds
+            request_id: X-Request-ID of the request, to find it in the results of the client
+        """
+        if status_code >= 500:
+            self.logger.warning("%s %s failed with %d after %.1f ms (request %s)",
+                                method, path, status_code, duration * 1000, request_id)
+        elif duration >= self.slow_seconds:
+            self.logger.warning("%s %s slow: %d after %.1f ms (request %s)",
+                                method, path, status_code, duration * 1000, request_id)
+
+    def stop(self):
+        """
+        Write the queued records and stop the background thread
+        """
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+class RequestLogMiddleware:
+    """
+    ASGI middleware timing every request to log the errors and the slow requests
+    """
+
+    def __init__(self, app, request_log):
+        self.app = app
+        self.request_log = request_log
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.request_log.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_and_record_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            self.request_log.request_done(scope["method"], scope["path"], status_code, time.perf_counter() - start,
+                                          scope.get("state", {}).get("request_id"))
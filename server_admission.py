@@ -0,0 +1,144 @@
+import asyncio
+import collections
+import os
+import time
+
+# Admission settings, read from the environment so that every uvicorn worker gets them
+MAX_CONCURRENCY_ENV = "ADMISSION_MAX_CONCURRENCY"
+MAX_QUEUE_ENV = "ADMISSION_MAX_QUEUE"
+QUEUE_TIMEOUT_ENV = "ADMISSION_QUEUE_TIMEOUT_MS"
+DEFAULT_MAX_QUEUE = 100
+RETRY_AFTER_SECONDS = 1
+
+# Never shed, so that the server stays observable when it is overloaded
+EXEMPT_PATHS = {"/metrics"}
+
+SHED_BODY = b'{"detail":"Server overloaded, retry later"}'
+
+class AdmissionControl:
+    """
+    Concurrency limit of a worker with a bounded waiting queue. A request over the limit waits for a slot
+    if the queue has room, and is rejected at once otherwise or when it waited longer than the queue timeout.
+    """
+
+    def __init__(self, max_concurrency=0, max_queue=DEFAULT_MAX_QUEUE, queue_timeout_ms=0, metrics=None):
+        """
+        Args:
+            max_concurrency: requests handled at the same time, 0 for no limit
+            max_queue: requests waiting for a slot, the next ones are rejected
+            queue_timeout_ms: longest wait for a slot, 0 to wait as long as needed
+            metrics: ServerMetrics receiving the queue depth, None to skip it
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout_ms / 1000 or None
+        self.metrics = metrics
+        self.active = 0
+        self.waiters = collections.deque()
+
+    @classmethod
+    def from_environment(cls, metrics=None):
+        """
+        Create the admission control with the settings of the environment
+        Args:
+            metrics: ServerMetrics receiving the queue depth
+        Returns:
+            AdmissionControl
+        """
+        return cls(
+            int(os.environ.get(MAX_CONCURRENCY_ENV, 0)),
+            int(os.environ.get(MAX_QUEUE_ENV, DEFAULT_MAX_QUEUE)),
+            float(os.environ.get(QUEUE_TIMEOUT_ENV, 0)),
+            metrics,
+        )
+
+    @property
+    def enabled(self):
+        return self.max_concurrency > 0
+
+    def _queue_changed(self):
+        if self.metrics is not None:
+            self.metrics.set_queued(len(self.waiters))
+
+    async def acquire(self):
+        """
+        Take a slot, waiting in the queue if needed
+        Returns:
+            True once the request holds a slot, False if it is rejected
+        """
+        if self.active < self.max_concurrency and not self.waiters:
+            self.active += 1
+            return True
+        if len(self.waiters) >= self.max_queue:
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self._queue_changed()
+        try:
+            # release() hands its slot over to the waiter, active does not change
+            await asyncio.wait_for(waiter, self.queue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            # Since Python 3.12 the timeout can win over a release() in the same loop iteration,
+            # the slot was handed over all the same and would be lost if the request were rejected
+            return waiter.done() and not waiter.cancelled()
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            self._queue_changed()
+
+    def release(self):
+        """
+        Give the slot of a finished request to the first waiter, or free it
+        """
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self._queue_changed()
+                return
+        self.active -= 1
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware applying the admission control to every request. A rejected request gets
+    a 503 with Retry-After at once instead of waiting in uvicorn, so the client can retry elsewhere.
+    """
+
+    def __init__(self, app, admission, metrics):
+        self.app = app
+        self.admission = admission
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.admission.enabled or scope["path"] in EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        admitted = await self.admission.acquire()
+        # Time spent waiting for a slot, for the Server-Timing header
+        scope.setdefault("state", {})["queue_seconds"] = time.perf_counter() - start
+        if not admitted:
+            self.metrics.request_shed()
+            await send({
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(SHED_BODY)).encode()),
+                    (b"retry-after", str(RETRY_AFTER_SECONDS).encode()),
+                ],
+            })
+            await send({"type": "http.response.body", "body": SHED_BODY})
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.admission.release()
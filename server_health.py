@@ -0,0 +1,123 @@
+import asyncio
+import collections
+import json
+import os
+
+# Readiness thresholds, read from the environment so that every uvicorn worker gets them
+READY_MAX_IN_FLIGHT_ENV = "READY_MAX_IN_FLIGHT"
+READY_MAX_LOOP_LAG_ENV = "READY_MAX_LOOP_LAG_MS"
+DEFAULT_MAX_IN_FLIGHT = 200
+DEFAULT_MAX_LOOP_LAG_MS = 100
+
+HEALTH_PATH = "/health"
+READY_PATH = "/ready"
+HEALTH_BODY = b'{"status":"ok"}'
+
+# The loop lag is sampled every LAG_INTERVAL seconds and the highest of the last LAG_SAMPLES samples is reported
+LAG_INTERVAL = 0.1
+LAG_SAMPLES = 10
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop wakes up a sleeping task, which is how long
+    ready requests wait before the loop gets to them
+    """
+
+    def __init__(self, interval=LAG_INTERVAL, samples=LAG_SAMPLES):
+        self.interval = interval
+        self.samples = collections.deque([0.0], maxlen=samples)
+        self.task = None
+
+    def start(self):
+        """
+        Start sampling, from the event loop of the worker
+        """
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval))
+
+    @property
+    def lag(self):
+        """
+        Highest loop lag of the last second, in seconds
+        """
+        return max(self.samples)
+
+class HealthMiddleware:
+    """
+    ASGI middleware answering the health checks before the framework, the request log and the metrics.
+    /health tells that the worker is alive. /ready answers 503 while the worker is saturated,
+    so that the load balancer stops sending it traffic instead of queueing requests on it.
+    """
+
+    def __init__(self, app, metrics, lag_monitor, max_in_flight=None, max_loop_lag_ms=None):
+        """
+        Args:
+            app: ASGI application
+            metrics: ServerMetrics of the worker, for the requests in flight
+            lag_monitor: LoopLagMonitor of the worker
+            max_in_flight: requests in flight above which the worker is not ready
+            max_loop_lag_ms: event loop lag above which the worker is not ready
+        """
+        self.app = app
+        self.metrics = metrics
+        self.lag_monitor = lag_monitor
+        self.max_in_flight = max_in_flight or int(os.environ.get(READY_MAX_IN_FLIGHT_ENV, DEFAULT_MAX_IN_FLIGHT))
+        self.max_loop_lag = (max_loop_lag_ms or float(os.environ.get(READY_MAX_LOOP_LAG_ENV, DEFAULT_MAX_LOOP_LAG_MS))) / 1000
+
+    def readiness(self):
+        """
+        Tell whether the worker can take more traffic
+        Returns:
+            (status code, JSON body)
+        """
+        in_flight = self.metrics.in_flight()
+        lag = self.lag_monitor.lag
+        reasons = []
+        if in_flight > self.max_in_flight:
+            reasons.append("in_flight")
+        if lag > self.max_loop_lag:
+            reasons.append("loop_lag")
+        body = {"ready": not reasons, "in_flight": in_flight, "loop_lag_ms": round(lag * 1000, 1), "reasons": reasons}
+        return (503 if reasons else 200), json.dumps(body, separators=(",", ":")).encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            path = scope["path"]
+            if path == HEALTH_PATH:
+                await send_response(send, 200, HEALTH_BODY)
+                return
+            if path == READY_PATH:
+                await send_response(send, *self.readiness())
+                return
+        await self.app(scope, receive, send)
+
+async def send_response(send, status_code, body):
+    """
+    Send a JSON response on a raw ASGI connection
+    Args:
+        send: ASGI send function
+        status_code: status code of the response
+        body: encoded JSON body
+    """
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
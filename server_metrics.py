@@ -0,0 +1,328 @@
+import bisect
+import fcntl
+import mmap
+import os
+import re
+import tempfile
+import time
+from shared_counter import get_shared_memory_directory
+
+# Environment variable giving the worker processes the file of the metrics
+SERVER_METRICS_ENV = "SERVER_METRICS_PATH"
+
+# Upper bounds in seconds of the handler latency histogram buckets, the last bucket is +Inf
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATUS_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+OTHER_ROUTE = "other"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+VALUE_SIZE = 8
+# Values at the start of every slot, before the counters of the routes
+IN_FLIGHT = 0
+QUEUED = 1
+SHED = 2
+HEADER_LENGTH = 3
+SAMPLE_PATTERN = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$')
+LABEL_PATTERN = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+class ServerMetrics:
+    """
+    Request metrics of the server: requests per route and status class, requests in flight
+    and handler latency histograms, exported in the Prometheus text format.
+    Every worker process writes only to its own slot of a memory-mapped file and /metrics
+    adds up the slots, so any worker answers for the whole server.
+    Without a file the metrics are those of the current process.
+    """
+
+    def __init__(self, routes, path=None):
+        """
+        Args:
+            routes: paths with their own metrics, any other path is counted as "other"
+            path: file created by ServerMetrics.create, None for in-process metrics
+        """
+        self.routes = list(routes) + [OTHER_ROUTE]
+        self.route_indexes = {route: index for index, route in enumerate(self.routes)}
+        self.counts_start = HEADER_LENGTH
+        self.buckets_start = self.counts_start + len(self.routes) * len(STATUS_CLASSES)
+        self.sums_start = self.buckets_start + len(self.routes) * (len(LATENCY_BUCKETS) + 1)
+        self.slot_length = self.sums_start + len(self.routes)
+
+        self.fd = None
+        self.slot = 0
+        if path is None:
+            self.slots = 1
+            self.all_values = memoryview(bytearray(self.slot_length * VALUE_SIZE)).cast("d")
+        else:
+            self.fd = os.open(path, os.O_RDWR)
+            self.slots = os.fstat(self.fd).st_size // (self.slot_length * VALUE_SIZE)
+            self.memory = mmap.mmap(self.fd, self.slots * self.slot_length * VALUE_SIZE)
+            self.all_values = memoryview(self.memory).cast("d")
+            self.slot = self._claim_slot()
+        self.values = self.all_values[self.slot * self.slot_length:(self.slot + 1) * self.slot_length]
+
+    @staticmethod
+    def create(routes, slots, prefix="metrics"):
+        """
+        Create a zeroed metrics file for the workers to share
+        Args:
+            routes: paths with their own metrics, the same as given to the workers
+            slots: number of worker slots, more than the workers so that restarted workers find one
+            prefix: prefix of the file name
+        Returns:
+            Path of the file
+        """
+        slot_length = HEADER_LENGTH + (len(routes) + 1) * (len(STATUS_CLASSES) + len(LATENCY_BUCKETS) + 2)
+        fd, path = tempfile.mkstemp(prefix=f"{prefix}-", dir=get_shared_memory_directory())
+        os.write(fd, bytes(slots * slot_length * VALUE_SIZE))
+        os.close(fd)
+        return path
+
+    def _slot_range(self, slot):
+        return self.slot_length * VALUE_SIZE, slot * self.slot_length * VALUE_SIZE
+
+    def _claim_slot(self):
+        """
+        Lock the first slot no live worker holds. The lock is released when the worker exits,
+        a restarted worker then takes the slot over and keeps its counters
+        Returns:
+            Index of the slot
+        """
+        for slot in range(self.slots):
+            try:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, *self._slot_range(slot))
+            except OSError:
+                continue
+            # The previous owner of the slot died, its requests are not in flight anymore
+            self.all_values[slot * self.slot_length + IN_FLIGHT] = 0
+            self.all_values[slot * self.slot_length + QUEUED] = 0
+            return slot
+        raise RuntimeError(f"No free metrics slot among {self.slots}")
+
+    def _is_live(self, slot):
+        """
+        Tell whether a worker holds a slot
+        """
+        if self.fd is None or slot == self.slot:
+            return True
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_SH | fcntl.LOCK_NB, *self._slot_range(slot))
+        except OSError:
+            return True
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, *self._slot_range(slot))
+        return False
+
+    def route_index(self, path):
+        """
+        Get the index of the route of a request path
+        """
+        return self.route_indexes.get(path, len(self.routes) - 1)
+
+    def request_started(self):
+        self.values[IN_FLIGHT] += 1
+
+    def in_flight(self):
+        """
+        Get the number of requests in flight in this worker
+        """
+        return int(self.values[IN_FLIGHT])
+
+    def set_queued(self, count):
+        """
+        Set the number of requests of this worker waiting for admission
+        """
+        self.values[QUEUED] = count
+
+    def request_shed(self):
+        """
+        Count a request rejected by the admission control
+        """
+        self.values[SHED] += 1
+
+    def request_done(self, route, status_code, duration):
+        """
+        Record a finished request
+        Args:
+            route: index of the route from route_index
+            status_code: response status code
+            duration: handler latency in seconds
+        """
+        values = self.values
+        values[IN_FLIGHT] -= 1
+        status_class = min(max(status_code // 100, 1), len(STATUS_CLASSES)) - 1
+        values[self.counts_start + route * len(STATUS_CLASSES) + status_class] += 1
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, duration)
+        values[self.buckets_start + route * (len(LATENCY_BUCKETS) + 1) + bucket] += 1
+        values[self.sums_start + route] += duration
+
+    def totals(self):
+        """
+        Add up the slots of every worker
+        Returns:
+            (list of the summed values, number of live workers)
+        """
+        totals = [0.0] * self.slot_length
+        workers = 0
+        for slot in range(self.slots):
+            values = self.all_values[slot * self.slot_length:(slot + 1) * self.slot_length]
+            live = self._is_live(slot)
+            workers += live
+            for index in range(self.slot_length):
+                totals[index] += values[index]
+            if not live:
+                totals[IN_FLIGHT] -= values[IN_FLIGHT]
+                totals[QUEUED] -= values[QUEUED]
+        return totals, workers
+
+    def export(self):
+        """
+        Format the metrics of the server in the Prometheus text format
+        Returns:
+            Text of the metrics
+        """
+        totals, workers = self.totals()
+        lines = [
+            "# HELP http_requests_total Requests handled, by route and status class.",
+            "# TYPE http_requests_total counter",
+        ]
+        for route_index, route in enumerate(self.routes):
+            for class_index, status_class in enumerate(STATUS_CLASSES):
+                count = totals[self.counts_start + route_index * len(STATUS_CLASSES) + class_index]
+                if count:
+                    lines.append(f'http_requests_total{{route="{route}",code="{status_class}"}} {count:.0f}')
+
+        lines += [
+            "# HELP http_requests_in_flight Requests being handled.",
+            "# TYPE http_requests_in_flight gauge",
+            f"http_requests_in_flight {totals[IN_FLIGHT]:.0f}",
+            "# HELP http_requests_queued Requests waiting for admission.",
+            "# TYPE http_requests_queued gauge",
+            f"http_requests_queued {totals[QUEUED]:.0f}",
+            "# HELP http_requests_shed_total Requests rejected with 503 by the admission control.",
+            "# TYPE http_requests_shed_total counter",
+            f"http_requests_shed_total {totals[SHED]:.0f}",
+            "# HELP http_request_duration_seconds Time spent in the application, by route.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for route_index, route in enumerate(self.routes):
+            start = self.buckets_start + route_index * (len(LATENCY_BUCKETS) + 1)
+            buckets = totals[start:start + len(LATENCY_BUCKETS) + 1]
+            if not any(buckets):
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+                cumulative += count
+                lines.append(f'http_request_duration_seconds_bucket{{route="{route}",le="{bound}"}} {cumulative:.0f}')
+            lines.append(f'http_request_duration_seconds_sum{{route="{route}"}} {totals[self.sums_start + route_index]:.6f}')
+            lines.append(f'http_request_duration_seconds_count{{route="{route}"}} {cumulative:.0f}')
+
+        lines += [
+            "# HELP server_workers Worker processes of the server.",
+            "# TYPE server_workers gauge",
+            f"server_workers {workers}",
+        ]
+        return "\n".join(lines) + "\n"
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting and timing every request
+    """
+
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        metrics = self.metrics
+        route = metrics.route_index(scope["path"])
+        status_code = 500
+
+        async def send_and_record_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        metrics.request_started()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            metrics.request_done(route, status_code, time.perf_counter() - start)
+
+def parse_metrics(text):
+    """
+    Parse metrics in the Prometheus text format
+    Args:
+        text: text of the metrics
+    Returns:
+        List of (name, labels dictionary, value)
+    """
+    samples = []
+    for line in text.splitlines():
+        match = SAMPLE_PATTERN.match(line.strip())
+        if line.startswith("#") or not match:
+            continue
+        name, labels, value = match.groups()
+        samples.append((name, dict(LABEL_PATTERN.findall(labels or "")), float(value)))
+    return samples
+
+def route_latency(samples, route):
+    """
+    Get the latency histogram of a route from parsed metrics
+    Args:
+        samples: parsed metrics from parse_metrics
+        route: route of the histogram
+    Returns:
+        (list of (upper bound, cumulative count), count, sum of the latencies)
+    """
+    buckets, count, total = [], 0, 0.0
+    for name, labels, value in samples:
+        if labels.get("route") != route:
+            continue
+        if name == "http_request_duration_seconds_bucket":
+            buckets.append((float(labels["le"]), value))
+        elif name == "http_request_duration_seconds_count":
+            count = value
+        elif name == "http_request_duration_seconds_sum":
+            total = value
+    return sorted(buckets), count, total
+
+def subtract_latency(after, before):
+    """
+    Get the latency histogram of the requests handled between two scrapes
+    Args:
+        after: route_latency of the second scrape
+        before: route_latency of the first scrape
+    Returns:
+        route_latency of the difference
+    """
+    earlier = dict(before[0])
+    buckets = [(bound, count - earlier.get(bound, 0)) for bound, count in after[0]]
+    return buckets, after[1] - before[1], after[2] - before[2]
+
+def histogram_quantile(buckets, quantile):
+    """
+    Estimate a quantile from cumulative buckets, interpolating inside the bucket like Prometheus does
+    Args:
+        buckets: list of (upper bound, cumulative count) sorted by bound
+        quantile: quantile between 0 and 1
+    Returns:
+        Estimated value, None without observations
+    """
+    if not buckets or buckets[-1][1] == 0:
+        return None
+    rank = quantile * buckets[-1][1]
+    lower_bound, lower_count = 0.0, 0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float("inf"):
+                return lower_bound
+            if count == lower_count:
+                return bound
+            return lower_bound + (bound - lower_bound) * (rank - lower_count) / (count - lower_count)
+        lower_bound, lower_count = bound, count
+    return lower_bound
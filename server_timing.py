@@ -0,0 +1,54 @@
+import time
+import uuid
+
+REQUEST_ID_HEADER = b"x-request-id"
+SERVER_TIMING_HEADER = b"server-timing"
+# Longer or non printable incoming IDs are replaced, they end up in headers and logs
+MAX_REQUEST_ID_LENGTH = 128
+
+def get_request_id(headers):
+    """
+    Get the request ID sent by the client
+    Args:
+        headers: raw ASGI headers
+    Returns:
+        Request ID as bytes, None if the client sent no valid one
+    """
+    for name, value in headers:
+        if name == REQUEST_ID_HEADER:
+            if 0 < len(value) <= MAX_REQUEST_ID_LENGTH and all(33 <= byte <= 126 for byte in value):
+                return value
+            return None
+    return None
+
+class TimingMiddleware:
+    """
+    ASGI middleware echoing the X-Request-ID of the client (or giving the request one) and adding
+    a Server-Timing header with the time spent waiting for admission (queue) and handling the request (handler),
+    so that the client can tell the time spent in the server from the time spent in the network
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        request_id = get_request_id(scope["headers"]) or uuid.uuid4().hex.encode()
+        state = scope.setdefault("state", {})
+        state["request_id"] = request_id.decode()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                total = time.perf_counter() - start
+                queue = state.get("queue_seconds", 0.0)
+                timing = f"queue;dur={queue * 1000:.3f}, handler;dur={(total - queue) * 1000:.3f}"
+                headers = list(message.get("headers", []))
+                headers += [(REQUEST_ID_HEADER, request_id), (SERVER_TIMING_HEADER, timing.encode())]
+                message = dict(message, headers=headers)
+            await send(message)
+
+        await self.app(scope, receive, send_with_timing)
@@ -0,0 +1,119 @@
+import asyncio
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Where the CPU work runs, read from the environment so that every uvicorn worker gets it
+WORK_EXECUTOR_ENV = "WORK_EXECUTOR"
+WORK_POOL_SIZE_ENV = "WORK_POOL_SIZE"
+
+# thread: a thread pool of the worker, process: a process pool, inline: on the event loop (blocks it)
+WORK_EXECUTORS = ("thread", "process", "inline")
+
+# Limits of the work a single request can ask for
+MAX_CPU_MS = 10000
+MAX_SLEEP_MS = 60000
+# A single request may take at most this share of the machine memory and never more than MEMORY_LIMIT_MB,
+# so that a memory request cannot get the worker OOM-killed on a t2.micro
+MEMORY_SHARE = 8
+MEMORY_LIMIT_MB = 256
+
+PAGE_SIZE = 4096
+
+def get_max_memory_mb():
+    """
+    Get the largest allocation a single request can ask for on this machine
+    Returns:
+        Size in MB
+    """
+    try:
+        memory_mb = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return MEMORY_LIMIT_MB
+    return max(1, min(MEMORY_LIMIT_MB, memory_mb // MEMORY_SHARE))
+
+MAX_MEMORY_MB = get_max_memory_mb()
+
+def burn_cpu(milliseconds):
+    """
+    Hash a buffer over and over until the calling thread used the given CPU time
+    Args:
+        milliseconds: CPU time to use
+    Returns:
+        Number of hashes computed
+    """
+    deadline = time.thread_time() + milliseconds / 1000
+    digest = bytes(64)
+    iterations = 0
+    while time.thread_time() < deadline:
+        for _ in range(100):
+            digest = hashlib.sha256(digest).digest()
+        iterations += 100
+    return iterations
+
+def allocate_memory(megabytes):
+    """
+    Allocate a buffer and write to every page of it, so that the memory is really committed
+    Args:
+        megabytes: size of the buffer
+    Returns:
+        The buffer
+    """
+    buffer = bytearray(megabytes * 1024 * 1024)
+    buffer[::PAGE_SIZE] = b"\x01" * len(range(0, len(buffer), PAGE_SIZE))
+    return buffer
+
+class WorkPool:
+    """
+    Runs the blocking work of the requests away from the event loop so that it keeps serving other requests
+    """
+
+    def __init__(self, kind="thread", size=None):
+        """
+        Args:
+            kind: one of WORK_EXECUTORS
+            size: number of threads or processes, the number of cores by default
+        """
+        if kind not in WORK_EXECUTORS:
+            raise ValueError(f"Unknown work executor {kind}, use one of {', '.join(WORK_EXECUTORS)}")
+        self.kind = kind
+        self.size = size or os.cpu_count()
+        self.executor = None
+
+    @classmethod
+    def from_environment(cls):
+        """
+        Create the work pool with the settings of the environment
+        Returns:
+            WorkPool
+        """
+        size = os.environ.get(WORK_POOL_SIZE_ENV)
+        return cls(os.environ.get(WORK_EXECUTOR_ENV, "thread"), int(size) if size else None)
+
+    async def run(self, function, *args):
+        """
+        Run a function in the pool
+        Args:
+            function: function to run, a module level function for the process pool
+            args: arguments of the function
+        Returns:
+            Result of the function
+        """
+        if self.kind == "inline":
+            return function(*args)
+        # Created on first use, the uvicorn supervisor imports the app too but never serves requests
+        if self.executor is None:
+            if self.kind == "process":
+                self.executor = ProcessPoolExecutor(max_workers=self.size)
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="work")
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def shutdown(self):
+        """
+        Stop the threads or processes of the pool
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,85 @@
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+
+# Environment variable giving the worker processes the file of the counters
+SHARED_COUNTER_ENV = "SHARED_COUNTER_PATH"
+
+COUNTER = struct.Struct("<Q")
+
+def get_shared_memory_directory():
+    """
+    Get the directory of the shared memory files, /dev/shm when it exists (it lives in RAM)
+    """
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+class SharedCounter:
+    """
+    Named counters shared by every worker process of the server.
+    The values live in a memory-mapped file and every increment holds an exclusive lock on it,
+    so concurrent workers never hand out the same number twice.
+    Without a file the counters are plain integers of the current process.
+    """
+
+    def __init__(self, names, path=None):
+        """
+        Args:
+            names: names of the counters
+            path: file created by SharedCounter.create, None for in-process counters
+        """
+        self.offsets = {name: index * COUNTER.size for index, name in enumerate(names)}
+        self.fd = None
+        self.values = dict.fromkeys(names, 0)
+        if path is not None:
+            self.fd = os.open(path, os.O_RDWR)
+            self.memory = mmap.mmap(self.fd, COUNTER.size * len(names))
+
+    @staticmethod
+    def create(names, prefix="counter"):
+        """
+        Create a zeroed counter file for the workers to share
+        Args:
+            names: names of the counters
+            prefix: prefix of the file name
+        Returns:
+            Path of the file
+        """
+        fd, path = tempfile.mkstemp(prefix=f"{prefix}-", dir=get_shared_memory_directory())
+        os.write(fd, bytes(COUNTER.size * len(names)))
+        os.close(fd)
+        return path
+
+    def increment(self, name):
+        """
+        Add one to a counter
+        Args:
+            name: name of the counter
+        Returns:
+            New value of the counter
+        """
+        if self.fd is None:
+            self.values[name] += 1
+            return self.values[name]
+
+        offset = self.offsets[name]
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            value = COUNTER.unpack_from(self.memory, offset)[0] + 1
+            COUNTER.pack_into(self.memory, offset, value)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return value
+
+    def get(self, name):
+        """
+        Read a counter
+        Args:
+            name: name of the counter
+        Returns:
+            Current value of the counter
+        """
+        if self.fd is None:
+            return self.values[name]
+        return COUNTER.unpack_from(self.memory, self.offsets[name])[0]
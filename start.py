@@ -1,8 +1,29 @@
 import boto3
 import sys, os, time
 import datetime
+import socket
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
 import paramiko
+import readiness
+from fleet_inventory import CLUSTER_TAG, FleetInventory
+from target_selection import TargetSelector, apply_selection
+
+# Files of the FastAPI server copied to every instance. launch_server.py goes last since
+# the user data script starts the server as soon as it appears
+SERVER_FILES = [
+    "shared_counter.py", "request_logging.py", "server_metrics.py", "server_work.py", "server_health.py",
+    "server_admission.py", "server_timing.py", "my_fastapi.py", "launch_server.py",
+]
+REMOTE_DIRECTORY = "/home/ubuntu"
+
+# Deployment: hosts deployed at the same time, attempts per host and SSH readiness timeout in seconds
+DEPLOY_WORKERS = 8
+DEPLOY_ATTEMPTS = 3
+SSH_READY_TIMEOUT = 300
+
+# Errors raised while sshd starts or cloud-init has not installed the key yet (AuthenticationException is an SSHException)
+SSH_NOT_READY_ERRORS = (paramiko.ssh_exception.NoValidConnectionsError, paramiko.SSHException, socket.error, EOFError)
 
 def get_key_pair(ec2_client):
     """
@@ -159,7 +180,7 @@ def get_subnet(ec2_client, vpc_id):
         print(f"Error retrieving subnets: {e}")
         sys.exit(1)
 
-def launch_ec2_instances(ec2_client, image_id, instance_type, key_name, security_group_id, subnet_id, num_instances):
+def launch_ec2_instances(ec2_client, image_id, instance_type, key_name, security_group_id, subnet_id, num_instances, cluster=None):
     """
     Launches EC2 instances.
     Args:
@@ -171,6 +192,7 @@ def launch_ec2_instances(ec2_client, image_id, instance_type, key_name, security
         subnet_id: The subnet ID.
         UserData: Script to run FastAPI file
         num_instances: Number of instances to launch.
+        cluster: Name of the cluster, set as the Cluster tag of the instances.
     Returns:
         List of EC2 instance objects.
     """
@@ -181,15 +203,19 @@ def launch_ec2_instances(ec2_client, image_id, instance_type, key_name, security
             python3 -m venv venv
             echo "source venv/bin/activate" >> /home/ubuntu/.bashrc
             source venv/bin/activate
-            pip install fastapi uvicorn
+            # uvicorn[standard] brings uvloop and httptools, orjson encodes the fast responses
+            pip install fastapi "uvicorn[standard]" orjson
 
-            # Wait for the my_fastapi.py file to be transferred
-            while [ ! -f /home/ubuntu/my_fastapi.py ]; do
+            # Let the kernel queue as many pending connections as the server backlog
+            sudo sysctl -w net.core.somaxconn=4096
+
+            # Wait for the server files to be transferred, launch_server.py comes last
+            while [ ! -f /home/ubuntu/launch_server.py ]; do
                 sleep 5
             done
 
-            # Start the FastAPI application
-            nohup uvicorn my_fastapi:app --host 0.0.0.0 --port 8000 &
+            # Start the FastAPI application, the launcher chooses the workers and settings for the instance type
+            INSTANCE_NUMBER=$(cat /home/ubuntu/instance_number) nohup python3 launch_server.py --response-mode fast > /home/ubuntu/server.log 2>&1 &
         '''
     try:
         response = instances = ec2_client.run_instances(
@@ -209,7 +235,7 @@ def launch_ec2_instances(ec2_client, image_id, instance_type, key_name, security
                             'Key': 'Name',
                             'Value': 'LabInstance'
                         }
-                    ]
+                    ] + ([{'Key': CLUSTER_TAG, 'Value': cluster}] if cluster else [])
                 }
             ]
         )
@@ -226,6 +252,57 @@ def launch_ec2_instances(ec2_client, image_id, instance_type, key_name, security
         print(f"Error launching instances: {e}")
         sys.exit(1)
 
+def wait_for_instances_running(ec2_client, instance_ids, timeout=600, interval=5):
+    """
+    Function to wait until all instances are running and have a public IP,
+    polling their states together with one describe_instances call per round
+    Args:
+        ec2_client: EC2 client
+        instance_ids: IDs of the instances
+        timeout: seconds before giving up
+        interval: seconds between two rounds
+    Returns:
+        Dictionary instance ID -> instance description (InstanceType, PublicIpAddress, ...)
+    """
+    start = time.monotonic()
+    paginator = ec2_client.get_paginator('describe_instances')
+    calls = 0
+    while True:
+        instances = {}
+        try:
+            for page in paginator.paginate(InstanceIds=list(instance_ids)):
+                calls += 1
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        instances[instance['InstanceId']] = instance
+        except ClientError as e:
+            calls += 1
+            # Instances just launched can be unknown to describe_instances for a few seconds
+            if e.response['Error']['Code'] != 'InvalidInstanceID.NotFound':
+                print(f"Error describing instances: {e}")
+                sys.exit(1)
+
+        failed = [
+            instance_id for instance_id, instance in instances.items()
+            if instance['State']['Name'] in ('shutting-down', 'terminated', 'stopping', 'stopped')
+        ]
+        if failed:
+            print(f"Instances stopped before running: {failed}")
+            sys.exit(1)
+
+        ready = [
+            instance_id for instance_id, instance in instances.items()
+            if instance['State']['Name'] == 'running' and instance.get('PublicIpAddress')
+        ]
+        elapsed = time.monotonic() - start
+        print(f"{len(ready)}/{len(instance_ids)} instances running after {elapsed:.0f}s ({calls} describe calls)")
+        if len(ready) == len(instance_ids):
+            return instances
+        if elapsed > timeout:
+            print(f"Instances not running after {timeout}s: {sorted(set(instance_ids) - set(ready))}")
+            sys.exit(1)
+        time.sleep(interval)
+
 def create_load_balancer(elbv2_client, security_group_id, subnet_id):
     """
     Function to create load balancer
@@ -278,7 +355,13 @@ def create_target_group(elbv2_client, name, vpc_id):
             VpcId=vpc_id,
             HealthCheckProtocol='HTTP',
             HealthCheckPort='8000',
-            HealthCheckPath='/',
+            # /ready answers 503 while the instance is saturated, two failed checks 10 s apart take it out
+            HealthCheckPath='/ready',
+            HealthCheckIntervalSeconds=10,
+            HealthCheckTimeoutSeconds=5,
+            HealthyThresholdCount=2,
+            UnhealthyThresholdCount=2,
+            Matcher={'HttpCode': '200'},
             TargetType='instance'
         )
         target_group_arn = response['TargetGroups'][0]['TargetGroupArn']
@@ -315,37 +398,113 @@ def register_targets(elbv2_client, target_group_arn, instance_ids):
         time.sleep(5)
         return register_targets(elbv2_client, target_group_arn, instance_ids)
 
-def transfer_file(instance_ip, key_file, local_file, remote_file):
+def connect_ssh(instance_ip, key_file, timeout=SSH_READY_TIMEOUT):
     """
-    Function to transfer FastAPIs file to instances
+    Function to connect to an instance as soon as its SSH server accepts the key, retrying with backoff
     Args:
         instance_ip: public IP of the instance
         key_file: path to pem key file
-        local_file: path to FstAPI local file
-        remote_file: path to desired directory
+        timeout: seconds before giving up
     Returns:
+        Connected paramiko SSHClient
     """
-    try:
-        # Create an SSH client instance
+    deadline = time.monotonic() + timeout
+    delay = 1
+    while True:
         ssh_client = paramiko.SSHClient()
         ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-        # Connect to the instance
-        ssh_client.connect(instance_ip, username='ubuntu', key_filename=key_file)
-
-        # Crear a SCP instance
-        scp = paramiko.SFTPClient.from_transport(ssh_client.get_transport())
-        
-        # Transfer the file
-        scp.put(local_file, remote_file)
-        
-        # Close connections
+        try:
+            ssh_client.connect(instance_ip, username='ubuntu', key_filename=key_file,
+                               timeout=10, banner_timeout=10, auth_timeout=10)
+            return ssh_client
+        except SSH_NOT_READY_ERRORS as e:
+            ssh_client.close()
+            if time.monotonic() + delay > deadline:
+                raise TimeoutError(f"SSH on {instance_ip} not ready after {timeout}s: {e}")
+            time.sleep(delay)
+            delay = min(delay * 2, 15)
+
+def transfer_file(ssh_client, local_files, remote_directory, instance_number):
+    """
+    Function to transfer FastAPIs files and the instance number over an SSH connection
+    Args:
+        ssh_client: connected paramiko SSHClient
+        local_files: paths to FastAPI local files
+        remote_directory: path to desired directory
+        instance_number: number of the instance in its cluster, shown in the responses
+    Returns:
+    """
+    # One SFTP session for every file
+    scp = paramiko.SFTPClient.from_transport(ssh_client.get_transport())
+    try:
+        # The instance number is read by the user data script when it starts the server
+        with scp.open(f"{remote_directory}/instance_number", 'w') as file:
+            file.write(str(instance_number))
+
+        # Transfer the files under a temporary name so that the server never starts from a partial file
+        for local_file in local_files:
+            remote_file = f"{remote_directory}/{os.path.basename(local_file)}"
+            scp.put(local_file, remote_file + ".part")
+            scp.posix_rename(remote_file + ".part", remote_file)
+    finally:
         scp.close()
-        ssh_client.close()
-        print(f"File {local_file} transferred to {instance_ip}:{remote_file}")
-    
-    except Exception as e:
-        print(f"Error transferring file to {instance_ip}: {e}")
+
+def deploy_instance(instance_ip, key_file, instance_number, attempts=DEPLOY_ATTEMPTS):
+    """
+    Function to deploy the FastAPI server to an instance, waiting for SSH and retrying failed transfers
+    Args:
+        instance_ip: public IP of the instance
+        key_file: path to pem key file
+        instance_number: number of the instance in its cluster
+        attempts: number of tries
+    Returns:
+        Dictionary with the ip, the seconds spent until SSH was ready and in total, the attempts and the error if it failed
+    """
+    start = time.monotonic()
+    result = {'ip': instance_ip, 'ssh_ready': None, 'seconds': None, 'attempts': 0, 'error': None}
+    for attempt in range(1, attempts + 1):
+        result['attempts'] = attempt
+        try:
+            ssh_client = connect_ssh(instance_ip, key_file)
+            if result['ssh_ready'] is None:
+                result['ssh_ready'] = time.monotonic() - start
+            try:
+                transfer_file(ssh_client, SERVER_FILES, REMOTE_DIRECTORY, instance_number)
+            finally:
+                ssh_client.close()
+            result['error'] = None
+            break
+        except Exception as e:
+            result['error'] = str(e)
+            print(f"Deployment to {instance_ip} failed (attempt {attempt}/{attempts}): {e}")
+            if attempt < attempts:
+                time.sleep(2 ** attempt)
+    result['seconds'] = time.monotonic() - start
+    return result
+
+def deploy_server(instance_ips, key_file, max_workers=DEPLOY_WORKERS):
+    """
+    Function to deploy the FastAPI server to every instance at the same time
+    Args:
+        instance_ips: list of (public IP, instance number in its cluster)
+        key_file: path to pem key file
+        max_workers: number of instances deployed at the same time
+    Returns:
+        List of the results of deploy_instance that failed
+    """
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(deploy_instance, ip, key_file, number) for ip, number in instance_ips]
+        results = [future.result() for future in futures]
+
+    for result in results:
+        status = f"failed: {result['error']}" if result['error'] else "deployed"
+        ssh_ready = f"{result['ssh_ready']:.1f}s" if result['ssh_ready'] is not None else "never"
+        print(f"  {result['ip']}: {status} in {result['seconds']:.1f}s "
+              f"(SSH ready after {ssh_ready}, {result['attempts']} attempt(s))")
+    failed = [result for result in results if result['error']]
+    print(f"Deployed to {len(results) - len(failed)}/{len(results)} instances in {time.monotonic() - start:.1f}s")
+    return failed
 
 def create_listener(elbv2_client, load_balancer_arn, tg_cluster1_arn, tg_cluster2_arn):
     """
@@ -436,34 +595,68 @@ def create_listener_rules(elbv2_client, listener_arn, tg_cluster1_arn, tg_cluste
     except ClientError as e:
         print(f"Error creating listener rules: {e}")
 
-def get_instance_metrics(instance_id):
+# Target selection: instances kept in each target group (None: every instance that is not an outlier,
+# more as the load grows) and seconds between two rounds of the controller
+TARGETS_PER_CLUSTER = None
+CONTROL_INTERVAL = 30
+
+# Metrics fetched for every instance by get_fleet_metrics: (metric name, statistic)
+FLEET_METRICS = [('CPUUtilization', 'Average')]
+# GetMetricData accepts up to 500 queries per request
+MAX_METRIC_QUERIES = 500
+
+def get_fleet_metrics(cloudwatch_client, instance_ids, metrics=FLEET_METRICS, minutes=5, period=300):
     """
-    Query CloudWatch for the CPU utilization
+    Query CloudWatch for the metrics of every instance with batched GetMetricData requests
     Args:
-        instance_id: Instance id
+        cloudwatch_client: boto3 CloudWatch client, reused between calls
+        instance_ids: IDs of the instances
+        metrics: list of (metric name, statistic) in the AWS/EC2 namespace
+        minutes: length of the window, ending now
+        period: seconds aggregated in one datapoint
     Returns:
-        The average CPU utilization of the instance
-    """
-    cloudwatch = boto3.client('cloudwatch')
-
-    # Fetch CPU Utilization data
-    response = cloudwatch.get_metric_statistics(
-        Namespace='AWS/EC2',
-        MetricName='CPUUtilization',
-        Dimensions=[{'Name': 'InstanceId', 'Value': instance_id}],
-        StartTime=datetime.datetime.now(datetime.UTC) - datetime.timedelta(minutes=5),
-        EndTime=datetime.datetime.now(datetime.UTC),
-        Period=300,
-        Statistics=['Average']
-    )
-
-    # Extract the CPU utilization value from the response
-    datapoints = response.get('Datapoints', [])
-    if not datapoints:
-        return None
+        Dictionary instance ID -> {metric name: latest value}, instances without data are left out
+    """
+    queries = {}
+    for i, instance_id in enumerate(instance_ids):
+        for j, (metric_name, statistic) in enumerate(metrics):
+            # Query IDs must start with a lowercase letter
+            queries[f"m{i}_{j}"] = {
+                'Id': f"m{i}_{j}",
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': 'AWS/EC2',
+                        'MetricName': metric_name,
+                        'Dimensions': [{'Name': 'InstanceId', 'Value': instance_id}],
+                    },
+                    'Period': period,
+                    'Stat': statistic,
+                },
+                'ReturnData': True,
+            }
 
-    # Return the average CPU utilization
-    return datapoints[0]['Average']
+    end_time = datetime.datetime.now(datetime.UTC)
+    start_time = end_time - datetime.timedelta(minutes=minutes)
+    paginator = cloudwatch_client.get_paginator('get_metric_data')
+    query_list = list(queries.values())
+    fleet_metrics = {}
+    try:
+        for start in range(0, len(query_list), MAX_METRIC_QUERIES):
+            for page in paginator.paginate(
+                MetricDataQueries=query_list[start:start + MAX_METRIC_QUERIES],
+                StartTime=start_time,
+                EndTime=end_time,
+                ScanBy='TimestampDescending',
+            ):
+                for result in page['MetricDataResults']:
+                    if not result['Values']:
+                        continue
+                    i, j = (int(part) for part in result['Id'][1:].split('_'))
+                    # Latest datapoint first, a later page never overwrites it
+                    fleet_metrics.setdefault(instance_ids[i], {}).setdefault(metrics[j][0], result['Values'][0])
+    except ClientError as e:
+        print(f"Error fetching CloudWatch metrics: {e}")
+    return fleet_metrics
 
 
 def get_registered_targets(elbv2_client, target_group_arn):
@@ -483,66 +676,69 @@ def get_registered_targets(elbv2_client, target_group_arn):
         print(f"Error fetching registered targets: {e}")
         return []
 
-def update_target_group(elbv2_client, fastest_instance, target_group_arn, registered_targets, instance_type):
+def update_cluster_targets(elbv2_client, ec2_client, inventory, selector, cluster, target_group_arn, cpu_metrics):
     """
-    Function to update the target group by deregistering all instances except the fastest one and registering the fastest instance if it's not already registered
+    Function to measure the instances of a cluster and keep the best ones registered in its target group
     Args:
-        elbv2_client: boro3 elbv2 client
-        fastest_instance: data of currently fastest intance
+        elbv2_client: boto3 elbv2 client
+        ec2_client: boto3 EC2 client, only used to refresh instances that stopped answering
+        inventory: FleetInventory of the instances
+        selector: TargetSelector of the cluster
+        cluster: name of the cluster
         target_group_arn: target group ARN
-        registered_targets: instances registered in target group
-        instance_type: type of an instance
+        cpu_metrics: CPU utilization of the instances from get_fleet_metrics, shown in the logs
     Returns:
     """
-    try:
-        # Deregister all instances except the fastest one
-        if fastest_instance['InstanceId'] not in registered_targets:
-            for instance_id in registered_targets:
-                if instance_id != fastest_instance['InstanceId']:
-                    elbv2_client.deregister_targets(
-                        TargetGroupArn=target_group_arn,
-                        Targets=[{'Id': instance_id}]
-                    )
-
-            # Register the fastest instance
-            elbv2_client.register_targets(
-                TargetGroupArn=target_group_arn,
-                Targets=[{'Id': fastest_instance['InstanceId']}]
-            )
+    instances = {
+        instance_id: inventory.get(instance_id)['PublicIpAddress']
+        for instance_id in inventory.running_ids() if inventory.get(instance_id)['Cluster'] == cluster
+    }
+    measurements, rate = selector.measure(instances)
+
+    # An instance that does not answer may have stopped, describe it again
+    inventory.mark_stale(instance_id for instance_id, measurement in measurements.items() if measurement['probe'] is None)
+    inventory.refresh(ec2_client)
+
+    selected = selector.select(measurements, rate)
+    registered = get_registered_targets(elbv2_client, target_group_arn)
+    for instance_id, measurement in sorted(measurements.items()):
+        probe = f"{measurement['probe'] * 1000:.1f}ms" if measurement['probe'] is not None else "unreachable"
+        server = f"{measurement['server'] * 1000:.1f}ms" if measurement['server'] is not None else "-"
+        cpu = cpu_metrics.get(instance_id, {}).get('CPUUtilization')
+        print(f"  {cluster} {instance_id}: ready={measurement['ready']} probe={probe} "
+              f"server p90={server} ({measurement['requests']} requests) "
+              f"cpu={f'{cpu:.1f}%' if cpu is not None else '-'} "
+              f"{'selected' if selected and instance_id in selected else 'out'}")
+    if selected is None:
+        print(f"No instance of {cluster} could be measured, keeping the targets as they are")
+        return
 
-    except Exception as e:
-        print(f"Error updating {instance_type} target group: {e}")
+    try:
+        added, removed = apply_selection(elbv2_client, target_group_arn, selected, registered)
+        print(f"{cluster}: {len(selected)} targets at {rate:.1f} requests/s, added {added}, removed {removed}")
+    except ClientError as e:
+        print(f"Error updating the {cluster} target group: {e}")
 
 
-def update_target_groups(elbv2_client, fastest_micro, fastest_large, tg_cluster1_arn, tg_cluster2_arn):
+def control_targets(elbv2_client, ec2_client, cloudwatch_client, inventory, target_groups, interval=CONTROL_INTERVAL):
     """
-    Function which checks registered instances in group and updates them to the fastest instance
+    Function to update the target groups periodically in an infinite loop
     Args:
-        elbv2_client: boro3 elbv2 client
-        fastest_micro: data of fastest micro instance
-        fastest_large: data of fastest large instance
-        tg_cluster1_arn: target group cluster1 ARN
-        tg_cluster2_arn: target group cluster2 ARN
+        elbv2_client: boto3 elbv2 client
+        ec2_client: boto3 EC2 client
+        cloudwatch_client: boto3 CloudWatch client
+        inventory: FleetInventory of the instances
+        target_groups: dictionary cluster name -> target group ARN
+        interval: seconds between two rounds
     Returns:
     """
-    try:
-        #print(f"Fastest t2.micro: {fastest_micro}")
-        #print(f"Fastest t2.large: {fastest_large}")
-
-        # Get the registered instances in each target group
-        registered_micro_targets = get_registered_targets(elbv2_client, tg_cluster1_arn)
-        registered_large_targets = get_registered_targets(elbv2_client, tg_cluster2_arn)
-
-        # Update the target groups for t2.micro and t2.large
-        update_target_group(elbv2_client, fastest_micro, tg_cluster1_arn, registered_micro_targets, "t2.micro")
-        update_target_group(elbv2_client, fastest_large, tg_cluster2_arn, registered_large_targets, "t2.large")
-
-        # Show the final state of registered instances
-        final_micro_targets = get_registered_targets(elbv2_client, tg_cluster1_arn)
-        final_large_targets = get_registered_targets(elbv2_client, tg_cluster2_arn)
-
-    except Exception as e:
-        print(f"Error updating target groups: {e}")
+    selectors = {cluster: TargetSelector(f"/{cluster}", TARGETS_PER_CLUSTER) for cluster in target_groups}
+    while True:
+        cpu_metrics = get_fleet_metrics(cloudwatch_client, inventory.running_ids())
+        for cluster, target_group_arn in target_groups.items():
+            update_cluster_targets(elbv2_client, ec2_client, inventory, selectors[cluster], cluster,
+                                   target_group_arn, cpu_metrics)
+        time.sleep(interval)
 
 
 def main():
@@ -553,6 +749,7 @@ def main():
         # Initialize EC2 and ELB clients
         ec2_client = boto3.client('ec2')
         elbv2_client = boto3.client('elbv2')
+        cloudwatch_client = boto3.client('cloudwatch')
 
         # Define essential AWS configuration
         vpc_id = get_vpc_id(ec2_client)
@@ -566,37 +763,37 @@ def main():
         # Launch EC2 instances for each cluster
         print("Launching EC2 instances...")
         instances_cluster1 = launch_ec2_instances(
-            ec2_client, image_id, 't2.micro', key_name, security_group_id, subnet_ids[0], 5
+            ec2_client, image_id, 't2.micro', key_name, security_group_id, subnet_ids[0], 5, 'cluster1'
         )
         instances_cluster2 = launch_ec2_instances(
-            ec2_client, image_id, 't2.large', key_name, security_group_id, subnet_ids[1], 4
+            ec2_client, image_id, 't2.large', key_name, security_group_id, subnet_ids[1], 4, 'cluster2'
         )
 
         # Wait for all instances to be in "running" state and collect instance details
-        instance_ips = []
-        instance_ids = []
-        for instance in instances_cluster1 + instances_cluster2:
-            instance.wait_until_running()
-            instance.reload()  # Reload instance attributes to get updated info
-            instance_ips.append(instance.public_ip_address)
-            instance_ids.append(instance.id)
+        instance_ids = [instance.id for instance in instances_cluster1 + instances_cluster2]
+        instance_details = wait_for_instances_running(ec2_client, instance_ids)
+        instance_ips = [instance_details[instance_id]['PublicIpAddress'] for instance_id in instance_ids]
+        # The control loop classifies the instances from this inventory instead of describing them again
+        inventory = FleetInventory.from_descriptions(instance_details)
 
         # Print the public IPs of the launched instances
         print("Public IPs of instances:", instance_ips)
 
-        # Wait for CloudWatch metrics to stabilize before determining fastest instances
-        print("Waiting for CloudWatch metrics to gather...")
-        time.sleep(60)  # Optional wait time to allow metrics to gather
-
-        # Transfer my_fastapi.py to all instances
+        # Transfer the FastAPI server to all instances as soon as SSH answers, instances are numbered from 1 in each cluster
         key_file_path = os.path.join(os.path.expanduser('~/.aws'), f"{key_name}.pem")
-        local_file_path_micro = ["my_fastapi1.py", "my_fastapi2.py", "my_fastapi3.py", "my_fastapi4.py", "my_fastapi5.py"]
-        local_file_path_large = ["my_fastapi1.py", "my_fastapi2.py", "my_fastapi3.py", "my_fastapi4.py"]
-
-        for num, micro_instance in enumerate(instances_cluster1):
-            transfer_file(micro_instance.public_ip_address, key_file_path, local_file_path_micro[num], "/home/ubuntu/my_fastapi.py")
-        for num, large_instance in enumerate(instances_cluster2):
-            transfer_file(large_instance.public_ip_address, key_file_path, local_file_path_large[num], "/home/ubuntu/my_fastapi.py")
+        deploy_targets = [
+            (instance_details[instance.id]['PublicIpAddress'], num + 1)
+            for cluster in (instances_cluster1, instances_cluster2)
+            for num, instance in enumerate(cluster)
+        ]
+        readiness.wait_for("SSH reachable", readiness.port_open_check(instance_ips, readiness.SSH_PORT))
+        print("Deploying the FastAPI server...")
+        failed = deploy_server(deploy_targets, key_file_path)
+        if failed:
+            print(f"The FastAPI server could not be deployed to {[result['ip'] for result in failed]}")
+            sys.exit(1)
+        # The user data starts the server once the files are there, after installing its packages
+        readiness.wait_for("FastAPI answering", readiness.app_answering_check(instance_ips))
 
         # Create load balancer
         lb_arn = create_load_balancer(elbv2_client, security_group_id, subnet_ids)
@@ -611,100 +808,22 @@ def main():
 
         # Create listener for load balancer
         create_listener(elbv2_client, lb_arn, tg_cluster1_arn, tg_cluster2_arn)
-        time.sleep(180)  # Wait for everything to stabilize and CloudWatch to gather data
-
-        # Now check for the fastest instances
-        fastest_micro, fastest_large = load_fastest_instances(instance_ids, ec2_client, tg_cluster1_arn, tg_cluster2_arn)
-
-        if fastest_micro and fastest_large:
-            print(f"Fastest t2.micro instance: {fastest_micro}")
-            print(f"Fastest t2.large instance: {fastest_large}")
-
-            # Update target groups with the fastest instances
-            update_target_groups(elbv2_client, fastest_micro, fastest_large, tg_cluster1_arn, tg_cluster2_arn)
-        else:
-            print("Unable to retrieve the fastest instances. Retrying...")
 
-        # Periodically check for the fastest instances in an infinite loop
-        while True:
-            fastest_micro, fastest_large = load_fastest_instances(instance_ids, ec2_client, tg_cluster1_arn, tg_cluster2_arn)
+        # Wait until the load balancer routes to healthy targets instead of a fixed delay,
+        # the target controller then starts from a cluster that answers
+        readiness.wait_for("listener rules", readiness.listener_rules_check(elbv2_client, lb_arn))
+        readiness.wait_for("load balancer active", readiness.load_balancer_active_check(elbv2_client, lb_arn))
+        readiness.wait_for("targets healthy", readiness.targets_healthy_check(elbv2_client, [tg_cluster1_arn, tg_cluster2_arn]))
+        readiness.wait_for("load balancer answering", readiness.load_balancer_answering_check(readiness.read_dns_name('load_balancer_dns.txt')))
 
-            if fastest_micro and fastest_large:
-                # Update target groups with the fastest instances
-                update_target_groups(elbv2_client, fastest_micro, fastest_large, tg_cluster1_arn, tg_cluster2_arn)
-            else:
-                print("Unable to retrieve the fastest instances. Retrying...")
-                time.sleep(10)
-
-            time.sleep(60)
+        # Keep the best instances of each cluster registered, instead of a single fastest one
+        control_targets(elbv2_client, ec2_client, cloudwatch_client, inventory,
+                        {'cluster1': tg_cluster1_arn, 'cluster2': tg_cluster2_arn})
 
     except Exception as e:
         print(f"Error during execution: {e}")
 
 
-def load_fastest_instances(instance_ids, ec2_client, tg_micro_arn, tg_large_arn, retries=5, wait_time=30):
-    """
-    Determine the fastest instances based on CloudWatch metrics
-    Args:
-        instance_ids: IDs of instances
-        ec2_client: boto3 EC2 client
-        tg_micro_arn: target group micro ARN
-        tg_large_arn: target group large ARN
-        retries: number of retries in case no data is available
-        wait_time: seconds to wait between retries
-    Returns:
-        Two dictionaries containing instance ID and target group ARN for the fastest t2.micro and t2.large instances.
-    """
-    for attempt in range(retries):
-        micro_instances = []
-        large_instances = []
-
-        # Fetch CPU utilization for each instance
-        for instance_id in instance_ids:
-            cpu_utilization = get_instance_metrics(instance_id)
-
-            if cpu_utilization is not None:
-                # Determine the instance type by describing the instance
-                try:
-                    instance_desc = ec2_client.describe_instances(InstanceIds=[instance_id])
-                    instance_type = instance_desc['Reservations'][0]['Instances'][0]['InstanceType']
-                except Exception as e:
-                    print(f"Error describing instance {instance_id}: {e}")
-                    continue
-
-                # Separate instances based on type
-                if instance_type == 't2.micro':
-                    micro_instances.append((instance_id, cpu_utilization))
-                elif instance_type == 't2.large':
-                    large_instances.append((instance_id, cpu_utilization))
-                else:
-                    print(f"Unknown instance type {instance_type} for instance {instance_id}")
-
-        # Ensure there are enough instances with available metrics
-        if micro_instances and large_instances:
-            # Sort instances by lowest CPU utilization (fastest)
-            micro_instances.sort(key=lambda x: x[1])
-            large_instances.sort(key=lambda x: x[1])
-
-            # Return the fastest t2.micro and t2.large instances
-            fastest_micro = {
-                'InstanceId': micro_instances[0][0],
-                'TargetGroupArn': tg_micro_arn
-            }
-
-            fastest_large = {
-                'InstanceId': large_instances[0][0],
-                'TargetGroupArn': tg_large_arn
-            }
-
-            return fastest_micro, fastest_large
-        else:
-            print(f"Not enough metrics data yet. Retrying {retries - attempt - 1} more times...")
-            time.sleep(wait_time) 
-
-    print("No sufficient CloudWatch data available after retries.")
-    return None, None
-
 if __name__ == "__main__":
     main()
 
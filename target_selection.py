@@ -0,0 +1,212 @@
+import math
+import statistics
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from server_metrics import histogram_quantile, parse_metrics, route_latency, subtract_latency
+
+APP_PORT = 8000
+PROBE_PATH = "/ready"
+METRICS_PATH = "/metrics"
+PROBE_TIMEOUT = 2
+
+# Quantile of the server-side latency used to rank the instances, and the requests needed between
+# two rounds for it to count
+LATENCY_QUANTILE = 0.9
+MIN_REQUESTS = 20
+# Rounds an instance without enough requests is still ranked with its last server-side latency.
+# A deregistered instance gets no traffic, so this is how long an outlier stays out before it is tried again
+SERVER_LATENCY_ROUNDS = 10
+# An instance whose server-side latency is above OUTLIER_FACTOR times the median of its cluster, and at least
+# OUTLIER_MIN_GAP seconds above it, is an outlier. It is pushed out after OUTLIER_ROUNDS rounds in a row
+# so that one slow round does not make it flap
+OUTLIER_FACTOR = 2.0
+OUTLIER_MIN_GAP = 0.005
+OUTLIER_ROUNDS = 2
+# Automatic K: one target per TARGET_RPS requests/s on the route, never under MIN_TARGETS
+TARGET_RPS = 200
+MIN_TARGETS = 2
+
+def probe_instance(ip, route, port=APP_PORT):
+    """
+    Time a readiness probe of an instance and read its metrics
+    Args:
+        ip: IP of the instance
+        route: route whose server-side latency is read from /metrics
+        port: port of the server
+    Returns:
+        Dictionary with ready, the probe round trip in seconds (None if unreachable)
+        and the route_latency of the route (None if /metrics did not answer)
+    """
+    result = {'ready': False, 'probe': None, 'latency': None}
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(f"http://{ip}:{port}{PROBE_PATH}", timeout=PROBE_TIMEOUT) as response:
+            response.read()
+            result['ready'] = response.status == 200
+    except urllib.error.HTTPError:
+        # 503: the server answers but is saturated
+        pass
+    except OSError:
+        return result
+    result['probe'] = time.perf_counter() - start
+    try:
+        with urllib.request.urlopen(f"http://{ip}:{port}{METRICS_PATH}", timeout=PROBE_TIMEOUT) as response:
+            result['latency'] = route_latency(parse_metrics(response.read().decode()), route)
+    except OSError:
+        pass
+    return result
+
+class TargetSelector:
+    """
+    Chooses the instances of a cluster that stay registered in its target group: the K best ones
+    ranked by server-side latency, without the outliers. The probe only tells whether an instance is reachable
+    and ready, its round trip goes over the internet from this machine and says little about the instance. Instances that recover
+    are selected again at the next round since every running instance is measured, registered or not.
+    Instances answering 503 on /ready are only saturated: they come after the ready ones but are not
+    pushed out for it, the ALB health check already takes them out of rotation until they recover.
+    """
+
+    def __init__(self, route, k=None, min_targets=MIN_TARGETS, target_rps=TARGET_RPS,
+                 outlier_factor=OUTLIER_FACTOR, outlier_rounds=OUTLIER_ROUNDS):
+        """
+        Args:
+            route: route of the cluster, e.g. /cluster1
+            k: number of targets to keep, None to keep every instance that is not an outlier,
+               with at least one target per target_rps requests/s and min_targets
+            min_targets: fewest targets with the automatic K
+            target_rps: requests/s one target handles, for the automatic K
+            outlier_factor: server-side latency above this times the median of the cluster makes an outlier
+            outlier_rounds: rounds in a row as an outlier before being pushed out
+        """
+        self.route = route
+        self.k = k
+        self.min_targets = min_targets
+        self.target_rps = target_rps
+        self.outlier_factor = outlier_factor
+        self.outlier_rounds = outlier_rounds
+        self.previous = {}
+        self.previous_time = None
+        self.strikes = {}
+        self.rounds = 0
+        # instance ID -> (last server-side latency, round it was measured in)
+        self.server_latency = {}
+
+    def measure(self, instances):
+        """
+        Probe every instance at the same time
+        Args:
+            instances: dictionary instance ID -> IP
+        Returns:
+            Dictionary instance ID -> {ready, probe (None if unreachable), server (quantile in seconds or None), requests},
+            and the request rate of the route over all instances since the last round.
+            Without enough requests in the round, server is the last one measured in the last SERVER_LATENCY_ROUNDS rounds
+        """
+        with ThreadPoolExecutor(max_workers=max(1, len(instances))) as executor:
+            results = dict(zip(instances, executor.map(lambda ip: probe_instance(ip, self.route), instances.values())))
+
+        self.rounds += 1
+        now = time.monotonic()
+        elapsed = now - self.previous_time if self.previous_time is not None else None
+        requests = 0
+        measurements = {}
+        for instance_id, result in results.items():
+            server, count = None, 0
+            latency, previous = result['latency'], self.previous.get(instance_id)
+            if latency is not None:
+                if previous is not None and latency[1] >= previous[1]:
+                    buckets, count, _ = subtract_latency(latency, previous)
+                    count = int(count)
+                    if count >= MIN_REQUESTS:
+                        server = histogram_quantile(buckets, LATENCY_QUANTILE)
+                self.previous[instance_id] = latency
+            if server is not None:
+                self.server_latency[instance_id] = (server, self.rounds)
+            elif instance_id in self.server_latency:
+                last_server, measured_round = self.server_latency[instance_id]
+                if self.rounds - measured_round < SERVER_LATENCY_ROUNDS:
+                    server = last_server
+            requests += count
+            measurements[instance_id] = {
+                'ready': result['ready'], 'probe': result['probe'], 'server': server, 'requests': count,
+            }
+        self.previous_time = now
+        rate = requests / elapsed if elapsed else 0.0
+        return measurements, rate
+
+    def choose_k(self, rate, candidates):
+        """
+        Number of targets to keep
+        Args:
+            rate: requests/s on the route
+            candidates: number of instances that can be selected
+        Returns:
+            K, at most the number of candidates
+        """
+        if self.k is not None:
+            return min(self.k, candidates)
+        return min(candidates, max(self.min_targets, math.ceil(rate / self.target_rps)))
+
+    def select(self, measurements, rate):
+        """
+        Choose the targets from the measurements of a round
+        Args:
+            measurements: from measure
+            rate: request rate from measure
+        Returns:
+            List of instance IDs to keep registered, best first, None if no instance could be reached
+        """
+        candidates = [instance_id for instance_id, measurement in measurements.items() if measurement['probe'] is not None]
+        if not candidates:
+            return None
+
+        # Instances without a server-side latency (no traffic for a while) rank as the median one
+        latencies = [measurements[instance_id]['server'] for instance_id in candidates
+                     if measurements[instance_id]['server'] is not None]
+        median = statistics.median(latencies) if latencies else 0.0
+        limit = max(self.outlier_factor * median, median + OUTLIER_MIN_GAP)
+
+        def server_latency(instance_id):
+            server = measurements[instance_id]['server']
+            return median if server is None else server
+
+        # Ready instances first, then the reachable ones that are saturated
+        candidates.sort(key=lambda instance_id: (not measurements[instance_id]['ready'], server_latency(instance_id)))
+        kept, outliers = [], []
+        for instance_id in candidates:
+            if server_latency(instance_id) > limit:
+                self.strikes[instance_id] = self.strikes.get(instance_id, 0) + 1
+            else:
+                self.strikes[instance_id] = 0
+            if self.strikes[instance_id] >= self.outlier_rounds:
+                outliers.append(instance_id)
+            else:
+                kept.append(instance_id)
+
+        k = self.choose_k(rate, len(candidates))
+        if self.k is not None:
+            kept = kept[:k]
+        # Outliers are only kept when the others cannot make K
+        return kept + outliers[:max(0, k - len(kept))]
+
+def apply_selection(elbv2_client, target_group_arn, selected, registered):
+    """
+    Register the selected instances that are not registered yet and deregister the others
+    Args:
+        elbv2_client: boto3 elbv2 client
+        target_group_arn: target group ARN
+        selected: IDs of the instances to keep registered
+        registered: IDs of the instances registered now
+    Returns:
+        (registered IDs, deregistered IDs)
+    """
+    to_register = [instance_id for instance_id in selected if instance_id not in registered]
+    to_deregister = [instance_id for instance_id in registered if instance_id not in selected]
+    # Register first so that the target group never runs empty
+    if to_register:
+        elbv2_client.register_targets(TargetGroupArn=target_group_arn, Targets=[{'Id': i} for i in to_register])
+    if to_deregister:
+        elbv2_client.deregister_targets(TargetGroupArn=target_group_arn, Targets=[{'Id': i} for i in to_deregister])
+    return to_register, to_deregister
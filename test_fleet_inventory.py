@@ -0,0 +1,61 @@
+import unittest
+
+from fleet_inventory import FleetInventory
+
+def describe(instance_id, state, ip=None):
+    return {'InstanceId': instance_id, 'InstanceType': 't2.micro', 'State': {'Name': state}, 'PublicIpAddress': ip}
+
+class FakeEC2:
+    """
+    describe_instances paginator answering with the given states and recording the described IDs
+    """
+
+    def __init__(self, states):
+        self.states = states
+        self.described = []
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, InstanceIds):
+        self.described.append(list(InstanceIds))
+        yield {'Reservations': [{'Instances': [describe(i, *self.states[i]) for i in InstanceIds]}]}
+
+class FleetInventoryTest(unittest.TestCase):
+
+    def test_pending_instance_is_described_until_it_runs(self):
+        inventory = FleetInventory.from_descriptions({
+            'a': describe('a', 'pending'), 'b': describe('b', 'running', '1.1.1.2'),
+        })
+        ec2 = FakeEC2({'a': ('pending',)})
+        self.assertEqual(inventory.refresh(ec2), [])
+        self.assertEqual(inventory.running_ids(), ['b'])
+
+        ec2.states['a'] = ('running', '1.1.1.1')
+        self.assertEqual(inventory.refresh(ec2), ['a'])
+        self.assertEqual(sorted(inventory.running_ids()), ['a', 'b'])
+        self.assertEqual(inventory.get('a')['PublicIpAddress'], '1.1.1.1')
+        # Running instances are only described again when marked stale
+        self.assertEqual(inventory.refresh(ec2), [])
+        self.assertEqual(ec2.described, [['a'], ['a']])
+
+    def test_stopped_instance_comes_back(self):
+        inventory = FleetInventory.from_descriptions({'a': describe('a', 'running', '1.1.1.1')})
+        ec2 = FakeEC2({'a': ('stopped',)})
+        inventory.mark_stale(['a'])
+        self.assertEqual(inventory.refresh(ec2), ['a'])
+        self.assertEqual(inventory.running_ids(), [])
+
+        ec2.states['a'] = ('running', '1.1.1.9')
+        self.assertEqual(inventory.refresh(ec2), ['a'])
+        self.assertEqual(inventory.running_ids(), ['a'])
+        self.assertEqual(inventory.get('a')['PublicIpAddress'], '1.1.1.9')
+
+    def test_terminated_instance_is_not_described_again(self):
+        inventory = FleetInventory.from_descriptions({'a': describe('a', 'terminated')})
+        ec2 = FakeEC2({})
+        self.assertEqual(inventory.refresh(ec2), [])
+        self.assertEqual(ec2.described, [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,35 @@
+import asyncio
+import time
+import unittest
+
+from server_admission import AdmissionControl
+
+class AdmissionControlTest(unittest.TestCase):
+
+    def test_slot_released_when_timeout_races_release(self):
+        async def scenario():
+            admission = AdmissionControl(max_concurrency=1, max_queue=10, queue_timeout_ms=50)
+            self.assertTrue(await admission.acquire())
+            asyncio.get_running_loop().call_later(0.04, admission.release)
+            waiter = asyncio.ensure_future(admission.acquire())
+            await asyncio.sleep(0)
+            # Block the loop so that the release and the queue timeout fire in the same iteration
+            time.sleep(0.06)
+            if await waiter:
+                admission.release()
+            return admission.active
+
+        self.assertEqual(asyncio.run(scenario()), 0)
+
+    def test_timeout_rejects_without_taking_a_slot(self):
+        async def scenario():
+            admission = AdmissionControl(max_concurrency=1, max_queue=10, queue_timeout_ms=10)
+            self.assertTrue(await admission.acquire())
+            admitted = await admission.acquire()
+            admission.release()
+            return admitted, admission.active, len(admission.waiters)
+
+        self.assertEqual(asyncio.run(scenario()), (False, 0, 0))
+
+if __name__ == "__main__":
+    unittest.main()
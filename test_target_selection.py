@@ -0,0 +1,185 @@
+import unittest
+from unittest import mock
+
+import start
+import target_selection
+from fleet_inventory import FleetInventory
+from server_metrics import LATENCY_BUCKETS
+from target_selection import SERVER_LATENCY_ROUNDS, TargetSelector, apply_selection
+
+def measurement(server, ready=True, probe=0.05):
+    return {'ready': ready, 'probe': probe, 'server': server, 'requests': 100 if server is not None else 0}
+
+def histogram(count, latency):
+    """
+    route_latency of count requests that all took the given latency
+    """
+    buckets = [(bound, count if bound >= latency else 0) for bound in LATENCY_BUCKETS + (float("inf"),)]
+    return buckets, count, count * latency
+
+class FakeELB:
+    """
+    Target group recording the register and deregister calls in order
+    """
+
+    def __init__(self, registered):
+        self.registered = set(registered)
+        self.calls = []
+
+    def describe_target_health(self, TargetGroupArn):
+        return {'TargetHealthDescriptions': [{'Target': {'Id': i}} for i in sorted(self.registered)]}
+
+    def register_targets(self, TargetGroupArn, Targets):
+        self.calls.append(('register', [target['Id'] for target in Targets]))
+        self.registered.update(target['Id'] for target in Targets)
+
+    def deregister_targets(self, TargetGroupArn, Targets):
+        self.calls.append(('deregister', [target['Id'] for target in Targets]))
+        self.registered.difference_update(target['Id'] for target in Targets)
+
+class FakeEC2:
+    def __init__(self, states):
+        self.states = states
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, InstanceIds):
+        yield {'Reservations': [{'Instances': [describe(i, *self.states[i]) for i in InstanceIds]}]}
+
+def describe(instance_id, state, ip=None):
+    return {'InstanceId': instance_id, 'InstanceType': 't2.micro', 'State': {'Name': state}, 'PublicIpAddress': ip,
+            'Tags': [{'Key': 'Cluster', 'Value': 'cluster1'}]}
+
+class SelectTest(unittest.TestCase):
+
+    def test_outlier_pushed_out_after_outlier_rounds(self):
+        selector = TargetSelector('/cluster1')
+        # The probe round trip over the internet is much larger than the server latencies and must not hide the outlier
+        measurements = {'a': measurement(0.030), 'b': measurement(0.001), 'c': measurement(0.001), 'd': measurement(0.001)}
+        self.assertIn('a', selector.select(measurements, 0))
+        self.assertEqual(selector.select(measurements, 0), ['b', 'c', 'd'])
+
+    def test_one_slow_round_does_not_push_out(self):
+        selector = TargetSelector('/cluster1')
+        slow = {'a': measurement(0.030), 'b': measurement(0.001), 'c': measurement(0.001)}
+        fast = {'a': measurement(0.001), 'b': measurement(0.001), 'c': measurement(0.001)}
+        for measurements in (slow, fast, slow, fast):
+            self.assertIn('a', selector.select(measurements, 0))
+
+    def test_small_differences_are_not_outliers(self):
+        selector = TargetSelector('/cluster1')
+        measurements = {'a': measurement(0.003), 'b': measurement(0.001), 'c': measurement(0.001)}
+        for _ in range(3):
+            self.assertIn('a', selector.select(measurements, 0))
+
+    def test_saturated_instances_stay_after_ready_ones(self):
+        measurements = {
+            'a': measurement(0.001), 'b': measurement(0.002, ready=False), 'c': measurement(0.001, ready=False),
+            'd': measurement(None, ready=False, probe=None),
+        }
+        self.assertEqual(TargetSelector('/cluster1').select(measurements, 0), ['a', 'c', 'b'])
+        self.assertEqual(TargetSelector('/cluster1', k=2).select(measurements, 0), ['a', 'c'])
+
+    def test_nothing_reachable_keeps_targets(self):
+        measurements = {'a': measurement(None, ready=False, probe=None)}
+        self.assertIsNone(TargetSelector('/cluster1').select(measurements, 0))
+
+    def test_automatic_k_fills_with_outliers(self):
+        selector = TargetSelector('/cluster1', min_targets=2, target_rps=100)
+        measurements = {
+            'a': measurement(0.001), 'b': measurement(0.030), 'c': measurement(0.001), 'd': measurement(0.050),
+            'e': measurement(0.001),
+        }
+        selector.select(measurements, 0)
+        self.assertEqual(selector.select(measurements, 0), ['a', 'c', 'e'])
+        # 350 requests/s need 4 targets, the best outlier fills the fourth place
+        self.assertEqual(selector.select(measurements, 350), ['a', 'c', 'e', 'b'])
+        self.assertEqual(TargetSelector('/cluster1', min_targets=3).choose_k(0, 2), 2)
+
+    def test_fixed_k_keeps_the_best(self):
+        measurements = {'a': measurement(0.004), 'b': measurement(0.002), 'c': measurement(0.003)}
+        self.assertEqual(TargetSelector('/cluster1', k=2).select(measurements, 1000), ['b', 'c'])
+
+class MeasureTest(unittest.TestCase):
+
+    def test_idle_instance_keeps_its_last_server_latency(self):
+        counts = {'a': 0, 'b': 0}
+        latencies = {'a': 0.1, 'b': 0.004}
+
+        def probe(ip, route):
+            return {'ready': True, 'probe': 0.05, 'latency': histogram(counts[ip], latencies[ip])}
+
+        selector = TargetSelector('/cluster1')
+        with mock.patch.object(target_selection, 'probe_instance', probe):
+            selector.measure({'a': 'a', 'b': 'b'})
+            counts['a'] += 100
+            counts['b'] += 100
+            measurements, _ = selector.measure({'a': 'a', 'b': 'b'})
+            self.assertGreater(measurements['a']['server'], 0.05)
+            # No traffic to a: its last latency is kept for SERVER_LATENCY_ROUNDS rounds, then it is tried again
+            for _ in range(SERVER_LATENCY_ROUNDS - 1):
+                counts['b'] += 100
+                measurements, _ = selector.measure({'a': 'a', 'b': 'b'})
+                self.assertGreater(measurements['a']['server'], 0.05)
+                self.assertEqual(measurements['a']['requests'], 0)
+            counts['b'] += 100
+            measurements, _ = selector.measure({'a': 'a', 'b': 'b'})
+            self.assertIsNone(measurements['a']['server'])
+
+    def test_unreachable_instance(self):
+        def probe(ip, route):
+            return {'ready': False, 'probe': None, 'latency': None}
+
+        with mock.patch.object(target_selection, 'probe_instance', probe):
+            measurements, rate = TargetSelector('/cluster1').measure({'a': 'a'})
+        self.assertIsNone(measurements['a']['probe'])
+        self.assertEqual(rate, 0.0)
+
+class ApplySelectionTest(unittest.TestCase):
+
+    def test_registers_before_deregistering(self):
+        elb = FakeELB(['a', 'b'])
+        self.assertEqual(apply_selection(elb, 'tg', ['c', 'a'], ['a', 'b']), (['c'], ['b']))
+        self.assertEqual(elb.calls, [('register', ['c']), ('deregister', ['b'])])
+
+    def test_nothing_to_change(self):
+        elb = FakeELB(['a'])
+        self.assertEqual(apply_selection(elb, 'tg', ['a'], ['a']), ([], []))
+        self.assertEqual(elb.calls, [])
+
+class RecoveryTest(unittest.TestCase):
+
+    def test_restarted_instance_is_registered_again(self):
+        inventory = FleetInventory.from_descriptions({
+            'a': describe('a', 'running', '1.1.1.1'), 'b': describe('b', 'running', '1.1.1.2'),
+            'c': describe('c', 'running', '1.1.1.3'),
+        })
+        ec2 = FakeEC2({'a': ('stopping',), 'b': ('running', '1.1.1.2'), 'c': ('running', '1.1.1.3')})
+        elb = FakeELB(['a', 'b', 'c'])
+        down = {'1.1.1.1'}
+
+        def probe(ip, route):
+            if ip in down:
+                return {'ready': False, 'probe': None, 'latency': None}
+            return {'ready': True, 'probe': 0.05, 'latency': histogram(0, 0.001)}
+
+        selector = TargetSelector('/cluster1')
+        with mock.patch.object(target_selection, 'probe_instance', probe), mock.patch('builtins.print'):
+            # a stops: it does not answer, is described again and leaves the target group
+            start.update_cluster_targets(elb, ec2, inventory, selector, 'cluster1', 'tg', {})
+            self.assertEqual(inventory.running_ids(), ['b', 'c'])
+            start.update_cluster_targets(elb, ec2, inventory, selector, 'cluster1', 'tg', {})
+            self.assertEqual(elb.registered, {'b', 'c'})
+
+            # a is pending then runs again with a new IP: it is still described every round and comes back
+            ec2.states['a'] = ('pending',)
+            start.update_cluster_targets(elb, ec2, inventory, selector, 'cluster1', 'tg', {})
+            ec2.states['a'] = ('running', '1.1.1.9')
+            start.update_cluster_targets(elb, ec2, inventory, selector, 'cluster1', 'tg', {})
+            self.assertEqual(inventory.get('a')['PublicIpAddress'], '1.1.1.9')
+            start.update_cluster_targets(elb, ec2, inventory, selector, 'cluster1', 'tg', {})
+        self.assertEqual(elb.registered, {'a', 'b', 'c'})
+
+if __name__ == "__main__":
+    unittest.main()